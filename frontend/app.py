@@ -10,6 +10,7 @@ import open3d as o3d
 import requests
 
 from horizon_net.layout_viewer import convert_to_3D
+from horizon_net.payload import decode_prediction, MIME_TYPE
 from horizon_net.preprocess import preprocess
 from horizon_net.skybox_grid import create_skybox
 
@@ -98,17 +99,24 @@ class PredictorBackend:
         return "3D_object.obj"
 
 
-def send_images_to_aws_lambda(image, model_url):
-    """Send images (encode to b64) to aws lambda function."""
+def send_images_to_aws_lambda(image, model_url, raw=False):
+    """Send images (encode to b64) to aws lambda function.
+
+    The prediction is requested as a binary payload, and decoded from JSON
+    if the function answers with it instead. With raw, the prediction also
+    holds the y_bon and y_cor outputs of the model.
+    """
     _buffer = BytesIO()  # bytes that live in memory
     image.save(_buffer, format="png")  # but which we write to like a file
     encoded_image = base64.b64encode(_buffer.getvalue()).decode("utf8")
 
-    headers = {"Content-type": "application/json"}
-    data = json.dumps({"image": "data:image/png;base64," + encoded_image})
+    headers = {"Content-type": "application/json", "Accept": MIME_TYPE}
+    data = json.dumps({"image": "data:image/png;base64," + encoded_image, "raw": raw})
 
     response = requests.post(model_url, data=data, headers=headers)
 
+    if response.headers.get("Content-Type", "").startswith(MIME_TYPE):
+        return decode_prediction(response.content)
     return response.json()
 
 
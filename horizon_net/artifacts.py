@@ -0,0 +1,174 @@
+"""
+Download model artifacts into a local content-addressed cache.
+
+Each artifact is stored under the sha256 of its content, and is only moved
+there once its checksum is verified. The expected checksum is taken from the
+checksums given to ArtifactStore, else from the checksum recorded in the cache
+when the artifact was last verified, and only then from the <filename>.sha256
+file published next to the artifact, so a warm cache is used without network.
+Downloads are written to a temporary file in the cache and renamed atomically,
+so concurrent cold starts never read a partly written artifact.
+
+The base URL is an https URL, or a file URL so that the store can be used
+offline with a local directory standing in for the s3 bucket:
+
+  HORIZONNET_MODEL_URL=file:///path/to/artifacts/ python -m horizon_net.horizonnet_reconstruction assets/preprocessed/demo_aligned_rgb.png
+
+where /path/to/artifacts holds horizonNet.pt, and the .sha256 files of the
+artifacts without a checksum in MODEL_CHECKSUMS, written for example with
+`sha256sum horizonNet_int8.pt > horizonNet_int8.pt.sha256`.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import hashlib
+import os
+import tempfile
+import threading
+from urllib import parse, request
+
+# Size of the chunks downloaded and hashed at once
+CHUNK_SIZE = 1 << 20
+# URL schemes the artifacts can be downloaded from
+URL_SCHEMES = ("https", "file")
+# Seconds a connection or a read of a download can block before it fails
+URL_TIMEOUT = 30
+
+
+def sha256_file(path):
+    """Return the hexadecimal sha256 of a file."""
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def _urlopen(url):
+    """Open an https or file URL, refusing the other schemes urllib supports."""
+    scheme = parse.urlsplit(url).scheme
+    if scheme not in URL_SCHEMES:
+        raise ValueError(
+            "Unsupported scheme of %s, expected one of %s"
+            % (url, ", ".join(URL_SCHEMES))
+        )
+    return request.urlopen(url, timeout=URL_TIMEOUT)  # noqa: S310
+
+
+class ArtifactStore:
+    """Local content-addressed cache of the artifacts published at base_url.
+
+    Parameters
+    ----------
+    base_url : str
+        URL of the directory holding the artifacts, ending with a slash
+    cache_dir : str
+        Local directory of the cache, artifacts are stored in its sha256 folder
+    checksums : dict, optional
+        Expected sha256 of the artifacts by filename. The others are read from
+        the cache, or from the <filename>.sha256 file next to the artifact
+    """
+
+    def __init__(self, base_url, cache_dir, checksums=None):
+        self.base_url = base_url
+        self.cache_dir = cache_dir
+        self.checksums = dict(checksums or {})
+        # Reentrant as the callback of a prefetch already done runs in prefetch
+        self._lock = threading.RLock()
+        self._pending = {}
+        self._executor = None
+
+    def fetch(self, filename):
+        """Return the local path of a verified artifact, downloading it if needed.
+
+        Waits for the background download of the artifact if one was started, and
+        downloads it again if that one failed.
+        """
+        with self._lock:
+            future = self._pending.get(filename)
+        if future is not None:
+            try:
+                return future.result()
+            except Exception as exception:
+                print("WARNING retrying the download of %s: %s" % (filename, exception))
+        return self._fetch(filename)
+
+    def prefetch(self, filename):
+        """Download an artifact in a background thread and return its Future."""
+        with self._lock:
+            if filename not in self._pending:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=1, thread_name_prefix="artifacts"
+                    )
+                future = self._executor.submit(self._fetch, filename)
+                self._pending[filename] = future
+                future.add_done_callback(functools.partial(self._forget, filename))
+            return self._pending[filename]
+
+    def _forget(self, filename, future):
+        # A failed download is not kept, so that the next fetch or prefetch retries it
+        if future.exception() is not None:
+            with self._lock:
+                if self._pending.get(filename) is future:
+                    del self._pending[filename]
+
+    def checksum(self, filename):
+        """Return the expected sha256 of an artifact."""
+        if filename not in self.checksums:
+            record = self._record_path(filename)
+            if os.path.isfile(record):
+                with open(record) as f:
+                    content = f.read()
+            else:
+                with _urlopen(self.base_url + filename + ".sha256") as f:
+                    content = f.read().decode()
+            self.checksums[filename] = content.split()[0].lower()
+        return self.checksums[filename]
+
+    def path(self, filename):
+        """Return the path of an artifact in the cache, whether it is there or not."""
+        extension = os.path.splitext(filename)[1]
+        return os.path.join(
+            self.cache_dir, "sha256", self.checksum(filename) + extension
+        )
+
+    def _record_path(self, filename):
+        # Checksum of the last verified download of filename, in sha256sum format
+        return os.path.join(self.cache_dir, "sha256", filename + ".sha256")
+
+    def _record(self, filename):
+        fd, part_path = tempfile.mkstemp(
+            dir=os.path.dirname(self._record_path(filename)), suffix=".part"
+        )
+        with os.fdopen(fd, "w") as f:
+            f.write("%s  %s\n" % (self.checksum(filename), filename))
+        os.replace(part_path, self._record_path(filename))
+
+    def _fetch(self, filename):
+        path = self.path(filename)
+        if os.path.isfile(path):
+            if not os.path.isfile(self._record_path(filename)):
+                self._record(filename)
+            return path
+
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, part_path = tempfile.mkstemp(dir=directory, suffix=".part")
+        try:
+            print("INFO downloading %s" % (self.base_url + filename))
+            sha = hashlib.sha256()
+            with os.fdopen(fd, "wb") as out, _urlopen(self.base_url + filename) as src:
+                for chunk in iter(lambda: src.read(CHUNK_SIZE), b""):
+                    sha.update(chunk)
+                    out.write(chunk)
+            if sha.hexdigest() != self.checksum(filename):
+                raise ValueError(
+                    "Checksum mismatch for %s: expected %s, got %s"
+                    % (filename, self.checksum(filename), sha.hexdigest())
+                )
+            os.replace(part_path, path)
+            self._record(filename)
+        finally:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+        return path
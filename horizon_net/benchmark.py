@@ -0,0 +1,350 @@
+"""
+Benchmark HorizonNet inference on the current host.
+
+Each benchmark is a sub-command, results are printed to stdout.
+
+Example usage as a script, from the root of the repository:
+
+  python -m horizon_net.benchmark batch horizon_net/assets/preprocessed/demo_aligned_rgb.png --n_images 32 --batch_size 8
+
+It will compare the throughput (images/sec) of predict_batch against calling
+predict once per image.
+
+  python -m horizon_net.benchmark tta horizon_net/assets/preprocessed/demo_aligned_rgb.png --flip --rotate 3
+
+It will compare the latency of predict with and without test-time augmentation.
+
+  python -m horizon_net.benchmark cold_start horizon_net/assets/preprocessed/demo_aligned_rgb.png --warmup 3
+
+It will compare the loading time and the latency of the first requests of a
+model loaded as is with a frozen model warmed up on a synthetic image.
+
+  python -m horizon_net.benchmark variants horizon_net/assets/preprocessed/demo_aligned_rgb.png --variants float32 channels_last
+
+It will compare the latency of predict with each exported model variant.
+
+  python -m horizon_net.benchmark lr_pad horizon_net/ckpt/resnet50_rnn__zind.pth
+
+It will check that the eager model with LRPadConv2d convolutions gives the same
+outputs as the model with LR_PAD wrapped convolutions, and compare their latency
+and the memory allocated by a forward pass.
+
+  python -m horizon_net.benchmark cascade --threshold 0.5
+
+It will report how often the cascade keeps the layout of the small model or
+escalates to the large one, the latency of each path against the large model
+alone, and the accuracy of the cascade layouts against the large model ones.
+
+  python -m horizon_net.benchmark workers horizon_net/assets/preprocessed/demo_aligned_rgb.png --workers 1 4 8
+
+It will compare the RSS and PSS of the host with 1, 4 and 8 worker processes
+loading their own model, or sharing the weights loaded by their parent.
+
+  python -m horizon_net.benchmark smoke --precisions float32 bfloat16
+
+It will check that predict runs at each precision on a scripted model with random
+weights, without downloading any artifact.
+"""
+import argparse
+import copy
+import glob
+import os
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+from .horizonnet_reconstruction import (
+    DEFAULT_CASCADE,
+    HorizonNet,
+    HorizonNetCascade,
+    PRECISIONS,
+)
+from .parity import DEFAULT_IMAGE_GLOB, layout_metrics, METRICS
+from .shared_pool import memory_usage_mb, SharedModelPool
+
+
+def time_call(fn, repeats=1):
+    """Return the mean wall-clock time in seconds of calling fn() repeats times."""
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    return (time.perf_counter() - start) / repeats
+
+
+def benchmark_batch(args):
+    """Compare looping over predict with predict_batch."""
+    model = HorizonNet()
+    images = [args.filename] * args.n_images
+
+    # Warm up once so that neither path pays the first-call overhead
+    model.predict(args.filename)
+
+    loop_time = time_call(lambda: [model.predict(image) for image in images])
+    print("predict loop         : %.2f images/sec" % (len(images) / loop_time))
+    for batch_size in args.batch_size:
+        batch_time = time_call(lambda: model.predict_batch(images, batch_size))
+        print(
+            "predict_batch (bs=%2d): %.2f images/sec"
+            % (batch_size, len(images) / batch_time)
+        )
+
+
+def benchmark_tta(args):
+    """Compare the latency of predict with and without test-time augmentation."""
+    settings = [False, {"flip": args.flip, "rotate": args.rotate}]
+    for tta in settings:
+        model = HorizonNet(tta=tta)
+        model.predict(args.filename)
+        latency = time_call(lambda: model.predict(args.filename), args.repeats)
+        print("tta=%s: %.1f ms" % (tta, latency * 1000))
+
+
+def benchmark_cold_start(args):
+    """Compare the first-request latency of a plain and of a frozen, warmed-up model."""
+    settings = [{}, {"freeze": True, "warmup": args.warmup}]
+    for kwargs in settings:
+        start = time.perf_counter()
+        model = HorizonNet(**kwargs)
+        load_time = time.perf_counter() - start
+        latencies = [
+            time_call(lambda: model.predict(args.filename))
+            for _ in range(args.requests)
+        ]
+        print(
+            "%s: load %.1f ms, requests %s ms"
+            % (
+                kwargs or "default",
+                load_time * 1000,
+                ", ".join("%.1f" % (latency * 1000) for latency in latencies),
+            )
+        )
+
+
+def benchmark_variants(args):
+    """Compare the latency of predict with several exported model variants."""
+    for variant in args.variants:
+        model = HorizonNet(variant=variant, warmup=1)
+        latency = time_call(lambda: model.predict(args.filename), args.repeats)
+        print("%-14s: %.1f ms" % (variant, latency * 1000))
+
+
+def _allocated_mb(model, x):
+    """Return the CPU memory in MB allocated by the operators of model(x)."""
+    from torch.profiler import profile, ProfilerActivity
+
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        model(x)
+    allocated = sum(
+        max(event.self_cpu_memory_usage, 0) for event in prof.key_averages()
+    )
+    return allocated / 2**20
+
+
+def benchmark_lr_pad(args):
+    """Compare the LR_PAD wrapped convolutions of a checkpoint with LRPadConv2d."""
+    from .misc.utils import load_trained_model
+    from .model import convert_lr_pad, HorizonNet as Net
+
+    torch.manual_seed(0)
+    x = torch.randint(0, 256, (args.batch_size, 512, 1024, 3), dtype=torch.uint8)
+    models = {"lr_pad": load_trained_model(Net, args.ckpt_path).eval()}
+    models["lr_pad_conv2d"] = convert_lr_pad(copy.deepcopy(models["lr_pad"]))
+
+    with torch.no_grad():
+        outputs = {name: model(x) for name, model in models.items()}
+        for name, model in models.items():
+            latency = time_call(lambda: model(x), args.repeats)
+            print(
+                "%-14s: %.1f ms, %.1f MB allocated"
+                % (name, latency * 1000, _allocated_mb(model, x))
+            )
+    for i, output in enumerate(["bon", "cor"]):
+        diff = outputs["lr_pad"][i] - outputs["lr_pad_conv2d"][i]
+        print("max abs diff %s: %.2e" % (output, np.abs(diff.numpy()).max()))
+
+
+def benchmark_cascade(args):
+    """Report the paths taken by HorizonNetCascade, their latency and accuracy."""
+    images = sorted(glob.glob(args.image_glob))
+    cascade = HorizonNetCascade(
+        threshold=args.threshold, spread_weight=args.spread_weight
+    )
+    # Warm up both stages so that the report does not count the first-call overhead
+    cascade.small.warmup()
+    cascade.large.warmup()
+
+    start = time.perf_counter()
+    expected = [cascade.large.predict(image) for image in images]
+    large_ms = (time.perf_counter() - start) * 1000 / len(images)
+    predictions = [cascade.predict(image) for image in images]
+
+    for key, value in cascade.report().items():
+        print("%-22s: %.4f" % (key, value))
+    print("%-22s: %.4f" % ("latency_large_ms", large_ms))
+    metrics = [layout_metrics(dt, gt) for dt, gt in zip(predictions, expected)]
+    for metric in METRICS:
+        print(
+            "%-22s: %.4f"
+            % (metric + " vs large", np.nanmean([m[metric] for m in metrics]))
+        )
+
+
+def benchmark_workers(args):
+    """Compare the host memory of worker processes with and without shared weights."""
+    for n_workers in args.workers:
+        for share in [False, True]:
+            with SharedModelPool(n_workers, share=share) as pool:
+                pool.predict_batch([args.filename] * n_workers)
+                rss, pss = memory_usage_mb(pool.pids())
+            print(
+                "workers=%d shared=%-5s: RSS %.0f MB, PSS %.0f MB"
+                % (n_workers, share, rss, pss)
+            )
+
+
+def benchmark_smoke(args):
+    """Run predict at each precision on a scripted model with random weights."""
+    from .model import HorizonNet as Net
+
+    torch.manual_seed(0)
+    net = Net(args.backbone, True, pretrained=False).eval()
+    image = np.random.default_rng(0).integers(0, 256, (512, 1024, 3), np.uint8)
+    with tempfile.TemporaryDirectory() as directory:
+        model_file = os.path.join(directory, "model.pt")
+        torch.jit.script(net).save(model_file)
+        for precision in args.precisions:
+            model = HorizonNet(model_file=model_file, precision=precision)
+            latency = time_call(lambda: model.predict(image))
+            prediction = model.predict(image)
+            missing = {"uv", "z0", "z1"} - set(prediction)
+            if missing:
+                raise ValueError(
+                    "Prediction at %s misses %s" % (precision, ", ".join(missing))
+                )
+            print(
+                "%-8s: %d corners, %.1f ms"
+                % (precision, len(prediction["uv"]), latency * 1000)
+            )
+
+
+def _setup_parser():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    batch_parser = subparsers.add_parser("batch", help=benchmark_batch.__doc__)
+    batch_parser.add_argument("filename", type=str, help="Aligned panorama image.")
+    batch_parser.add_argument(
+        "--n_images",
+        type=int,
+        default=32,
+        help="Number of images in the simulated job.",
+    )
+    batch_parser.add_argument(
+        "--batch_size",
+        type=int,
+        nargs="+",
+        default=[4, 8, 16],
+        help="Batch sizes to benchmark predict_batch with.",
+    )
+    batch_parser.set_defaults(func=benchmark_batch)
+
+    tta_parser = subparsers.add_parser("tta", help=benchmark_tta.__doc__)
+    tta_parser.add_argument("filename", type=str, help="Aligned panorama image.")
+    tta_parser.add_argument("--flip", action="store_true", help="Add flip tta.")
+    tta_parser.add_argument(
+        "--rotate", type=int, default=3, help="Number of tta rotations."
+    )
+    tta_parser.add_argument(
+        "--repeats", type=int, default=10, help="Number of timed predictions."
+    )
+    tta_parser.set_defaults(func=benchmark_tta)
+
+    cold_start_parser = subparsers.add_parser(
+        "cold_start", help=benchmark_cold_start.__doc__
+    )
+    cold_start_parser.add_argument("filename", type=str, help="Aligned panorama image.")
+    cold_start_parser.add_argument(
+        "--warmup", type=int, default=3, help="Number of warm-up runs."
+    )
+    cold_start_parser.add_argument(
+        "--requests", type=int, default=3, help="Number of timed first requests."
+    )
+    cold_start_parser.set_defaults(func=benchmark_cold_start)
+
+    variants_parser = subparsers.add_parser("variants", help=benchmark_variants.__doc__)
+    variants_parser.add_argument("filename", type=str, help="Aligned panorama image.")
+    variants_parser.add_argument(
+        "--variants",
+        type=str,
+        nargs="+",
+        default=["float32", "channels_last"],
+        help="Torchscript model variants to benchmark.",
+    )
+    variants_parser.add_argument(
+        "--repeats", type=int, default=10, help="Number of timed predictions."
+    )
+    variants_parser.set_defaults(func=benchmark_variants)
+
+    lr_pad_parser = subparsers.add_parser("lr_pad", help=benchmark_lr_pad.__doc__)
+    lr_pad_parser.add_argument("ckpt_path", type=str, help="Trained checkpoint.")
+    lr_pad_parser.add_argument(
+        "--batch_size", type=int, default=1, help="Batch size of the random input."
+    )
+    lr_pad_parser.add_argument(
+        "--repeats", type=int, default=10, help="Number of timed forward passes."
+    )
+    lr_pad_parser.set_defaults(func=benchmark_lr_pad)
+
+    cascade_parser = subparsers.add_parser("cascade", help=benchmark_cascade.__doc__)
+    cascade_parser.add_argument(
+        "--image_glob",
+        type=str,
+        default=DEFAULT_IMAGE_GLOB,
+        help="Aligned panoramas to predict.",
+    )
+    cascade_parser.add_argument(
+        "--threshold",
+        type=float,
+        default=DEFAULT_CASCADE["threshold"],
+        help="Escalate the layouts scoring below it.",
+    )
+    cascade_parser.add_argument(
+        "--spread_weight",
+        type=float,
+        default=DEFAULT_CASCADE["spread_weight"],
+        help="Weight of the ceiling height spread in the score.",
+    )
+    cascade_parser.set_defaults(func=benchmark_cascade)
+
+    workers_parser = subparsers.add_parser("workers", help=benchmark_workers.__doc__)
+    workers_parser.add_argument("filename", type=str, help="Aligned panorama image.")
+    workers_parser.add_argument(
+        "--workers",
+        type=int,
+        nargs="+",
+        default=[1, 4, 8],
+        help="Numbers of worker processes to measure.",
+    )
+    workers_parser.set_defaults(func=benchmark_workers)
+
+    smoke_parser = subparsers.add_parser("smoke", help=benchmark_smoke.__doc__)
+    smoke_parser.add_argument(
+        "--backbone", type=str, default="resnet18", help="Backbone of the model."
+    )
+    smoke_parser.add_argument(
+        "--precisions",
+        type=str,
+        nargs="+",
+        default=list(PRECISIONS),
+        help="Precisions to run predict at.",
+    )
+    smoke_parser.set_defaults(func=benchmark_smoke)
+    return parser
+
+
+if __name__ == "__main__":
+    parser = _setup_parser()
+    args = parser.parse_args()
+    args.func(args)
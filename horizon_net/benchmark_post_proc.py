@@ -0,0 +1,389 @@
+"""
+Check and benchmark the post-processing of misc/post_proc.py against its original implementations.
+
+Each function is a sub-command. Its current implementation is compared with
+the original one, kept here as a reference, on randomized inputs: the outputs
+must be identical. The mean time of a call of both implementations is then
+printed to stdout. Torch is not needed.
+
+Example usage as a script, from the root of the repository:
+
+  python -m horizon_net.benchmark_post_proc vote --n_cases 10000 --sizes 64 256 1024
+
+It will check that post_proc.vote returns the same outputs as the original
+pairwise implementation on 10000 random inputs, and compare their latency on
+inputs of 64, 256 and 1024 values.
+
+  python -m horizon_net.benchmark_post_proc rot_rad --sizes 4 8 16
+
+It will check that post_proc.get_rot_rad returns the same rotation as the
+original implementation fitting a scikit-learn PCA to each wall, up to
+--atol degrees, on random rooms of 4, 8 and 16 walls, and compare the import
+time of post_proc with the import time of scikit-learn. The original
+implementation needs scikit-learn, from requirements/dev.txt.
+
+  python -m horizon_net.benchmark_post_proc polygon --sizes 4 8 16 32
+
+It will check that post_proc.is_simple_polygon agrees with shapely
+Polygon.is_valid on random general layouts and on random polygons with many
+touching and overlapping walls, and compare their latency and import time.
+"""
+import argparse
+import subprocess  # noqa: S404
+import sys
+import time
+
+import numpy as np
+from scipy.spatial.distance import pdist, squareform
+
+from .misc import post_proc
+
+
+def time_call(fn, repeats=1):
+    """Return the mean wall-clock time in seconds of calling fn() repeats times."""
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    return (time.perf_counter() - start) / repeats
+
+
+def vote_reference(vec, tol):
+    """Original post_proc.vote, with the distances of every pair of values."""
+    vec = np.sort(vec)
+    n = np.arange(len(vec))[::-1]
+    n = n[:, None] - n[None, :] + 1.0
+    dist = squareform(pdist(vec[:, None], "minkowski", p=1) + 1e-9)
+
+    invalid = (n < len(vec) * 0.4) | (dist > tol)
+    if (~invalid).sum() == 0 or len(vec) < tol:
+        best_fit = np.median(vec)
+        p_score = 0
+    else:
+        dist[invalid] = 1e5
+        n[invalid] = -1
+        score = n
+        max_idx = score.argmax()
+        max_row = max_idx // len(vec)
+        max_col = max_idx % len(vec)
+        assert max_col > max_row
+        best_fit = vec[max_row : max_col + 1].mean()
+        p_score = (max_col - max_row + 1) / len(vec)
+
+    l1_score = np.abs(vec - best_fit).mean()
+
+    return best_fit, p_score, l1_score
+
+
+def get_rot_rad_reference(
+    init_coorx, coory, z=50, coorW=1024, coorH=512, floorW=1024, floorH=512, tol=5
+):
+    """Original post_proc.get_rot_rad, fitting a scikit-learn PCA to each wall."""
+    from sklearn.decomposition import PCA
+
+    gpid = post_proc.get_gpid(init_coorx, coorW)
+    coor = np.hstack([np.arange(coorW)[:, None], coory[:, None]])
+    xy = post_proc.np_coor2xy(coor, z, coorW, coorH, floorW, floorH)
+
+    rot_rad_suggestions = []
+    for j in range(len(init_coorx)):
+        pca = PCA(n_components=1)
+        pca.fit(xy[gpid == j])
+        px, py = pca.components_[0]
+        if px < 0:
+            px, py = -px, -py
+        rad = np.arctan2(py, px) * 180 / np.pi
+        if rad > 45:
+            rad = 90 - rad
+        elif rad < -45:
+            rad = -90 - rad
+        else:
+            rad = -rad
+        rot_rad_suggestions.append(rad)
+    rot_rad_suggestions = np.sort(rot_rad_suggestions + [1e9])
+
+    rot_rad = np.mean(rot_rad_suggestions[:-1])
+    best_rot_rad_sz = -1
+    last_j = 0
+    for j in range(1, len(rot_rad_suggestions)):
+        if rot_rad_suggestions[j] - rot_rad_suggestions[j - 1] > tol:
+            last_j = j
+        elif j - last_j > best_rot_rad_sz:
+            rot_rad = rot_rad_suggestions[last_j : j + 1].mean()
+            best_rot_rad_sz = j - last_j
+
+    dx = int(round(rot_rad * 1024 / 360))
+    return dx, rot_rad
+
+
+def random_room(rng, n_walls, noise=0.5, coorW=1024):
+    """Return the wall-wall columns and the floor boundary of a random convex room.
+
+    The room has n_walls walls, and is seen from a camera inside it as
+    post_proc.np_coor2xy projects it.
+    """
+    angles = np.sort(rng.uniform(0, 2 * np.pi, n_walls))
+    angles += np.arange(n_walls) * 0.2
+    angles *= 2 * np.pi / (angles[-1] + 0.2)
+    corners = np.stack([np.sin(angles), -np.cos(angles)], 1)
+    corners *= rng.uniform(100, 250, (n_walls, 1))
+
+    # Distance along the ray of each column to the first wall it hits
+    u = post_proc.np_coorx2u(np.arange(coorW), coorW)
+    ray = np.stack([np.sin(u), -np.cos(u)], 1)
+    a, b = corners, np.roll(corners, -1, 0)
+    edge = b - a
+    denom = ray[:, None, 0] * edge[None, :, 1] - ray[:, None, 1] * edge[None, :, 0]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = (
+            a[None, :, 0] * edge[None, :, 1] - a[None, :, 1] * edge[None, :, 0]
+        ) / denom
+        s = (a[None, :, 0] * ray[:, None, 1] - a[None, :, 1] * ray[:, None, 0]) / denom
+    t[(t <= 0) | (s < 0) | (s > 1) | ~np.isfinite(t)] = np.inf
+    xy = ray * t.min(1)[:, None] + [512 - 0.5, 256 - 0.5]
+
+    coory = post_proc.np_xy2coor(xy)[:, 1] + rng.normal(0, noise, coorW)
+    init_coorx = post_proc.np_xy2coor(corners + [512 - 0.5, 256 - 0.5])[:, 0]
+    return np.sort(init_coorx), coory
+
+
+def random_rot_rad_input(rng, size=None):
+    """Return the arguments of get_rot_rad for a random room."""
+    return random_room(rng, size or int(rng.integers(4, 13)))
+
+
+def random_layout_input(rng, size=None):
+    """Return the wall-wall columns, floor boundary and tolerance of a random layout.
+
+    The layout is a random convex room, or a random walk of the floor boundary
+    with random wall-wall columns, which goes through the fallbacks of
+    gen_ww_general more often.
+    """
+    n_walls = size or int(rng.integers(2, 17))
+    tol = float(rng.uniform(1, 10))
+    if size or rng.random() < 0.5:
+        return random_room(rng, n_walls, noise=rng.uniform(0, 2)) + (tol,)
+    init_coorx = np.sort(rng.choice(1024, n_walls, replace=False)).astype(np.float64)
+    coory = 380 + np.cumsum(rng.normal(0, rng.uniform(0.1, 3), 1024))
+    return init_coorx, np.clip(coory, 260, 510), tol
+
+
+def is_valid_polygon_reference(xy):
+    """Original validity check of the general layouts, with shapely."""
+    from shapely.geometry import Polygon
+
+    return Polygon(xy).is_valid
+
+
+def random_polygon_input(rng, size=None):
+    """Return the corners of a random layout or polygon.
+
+    The corners are those of a random general layout, or of a random polygon on
+    a small grid, which often touches or overlaps itself.
+    """
+    if size is None and rng.random() < 0.5:
+        n_corners = int(rng.integers(3, 9))
+        return (rng.integers(0, 4, (n_corners, 2)).astype(np.float32),)
+    init_coorx, coory, tol = random_layout_input(rng, size)
+    gpid = post_proc.get_gpid(init_coorx, 1024)
+    coor = np.hstack([np.arange(1024)[:, None], coory[:, None]])
+    try:
+        xy_cor = post_proc.gen_ww_general(
+            init_coorx, post_proc.np_coor2xy(coor), gpid, tol
+        )
+    except AssertionError:
+        return random_polygon_input(rng, size)
+    if len(xy_cor) < 3:
+        # shapely raises on them, is_simple_polygon returns False
+        return random_polygon_input(rng, size)
+    xy2d = np.zeros((len(xy_cor), 2), np.float32)
+    for i in range(len(xy_cor)):
+        xy2d[i, xy_cor[i]["type"]] = xy_cor[i]["val"]
+        xy2d[i, xy_cor[i - 1]["type"]] = xy_cor[i - 1]["val"]
+    return (xy2d,)
+
+
+def _same_rotation(atol):
+    def same(a, b):
+        if isinstance(a, str) or isinstance(b, str):
+            return a == b
+        return a[0] == b[0] and abs(a[1] - b[1]) <= atol
+
+    return same
+
+
+def import_time(module):
+    """Return the time in seconds to import module in a new interpreter."""
+    code = "import time; t = time.perf_counter(); import %s; print(time.perf_counter() - t)"
+    output = subprocess.check_output(  # noqa: S603
+        [sys.executable, "-c", code % module]
+    )
+    return float(output)
+
+
+def random_vote_input(rng, size=None):
+    """Return random wall coordinates and a tolerance, with ties and float32 values."""
+    size = size or int(rng.integers(1, 300))
+    kind = rng.integers(4)
+    if kind == 0:
+        return rng.normal(500, 20, size), float(rng.choice([1, 2.5, 5, 10]))
+    if kind == 1:
+        return np.round(rng.normal(500, 5, size)), float(rng.choice([1, 2, 5]))
+    if kind == 2:
+        # Quarter steps, so that many pairs are exactly tol apart
+        vec = (rng.integers(0, 40, size) * 0.25).astype(np.float32)
+        return vec, float(rng.integers(1, 20)) * 0.25
+    return rng.uniform(0, 1024, size), float(rng.choice([0.1, 5, 40]))
+
+
+def _call(fn, *args):
+    # Both implementations must fail the same way on the degenerate inputs
+    try:
+        return fn(*args)
+    except Exception as e:
+        return type(e).__name__
+
+
+def _same(a, b):
+    if isinstance(a, str) or isinstance(b, str):
+        return a == b
+    if not isinstance(a, tuple):
+        return np.array_equal(a, b, equal_nan=True)
+    return all(np.array_equal(x, y, equal_nan=True) for x, y in zip(a, b))
+
+
+def check_equivalence(fn, reference, make_input, n_cases, seed, same=_same):
+    """Return the number of random inputs on which fn and reference differ."""
+    rng = np.random.default_rng(seed)
+    n_failed = 0
+    for _ in range(n_cases):
+        args = make_input(rng)
+        if not same(_call(fn, *args), _call(reference, *args)):
+            n_failed += 1
+    return n_failed
+
+
+def run(name, fn, reference, make_input, args, same=_same):
+    """Check fn against reference on random inputs, then time both."""
+    n_failed = check_equivalence(
+        fn, reference, make_input, args.n_cases, args.seed, same
+    )
+    print("%s: %d / %d random inputs differ" % (name, n_failed, args.n_cases))
+    rng = np.random.default_rng(args.seed)
+    for size in args.sizes:
+        inputs = make_input(rng, size)
+        latencies = [
+            time_call(lambda: impl(*inputs), args.repeats) * 1000
+            for impl in [reference, fn]
+        ]
+        print(
+            "size %5d: original %.3f ms, current %.3f ms, speedup x%.1f"
+            % (size, latencies[0], latencies[1], latencies[0] / latencies[1])
+        )
+    if n_failed:
+        sys.exit(1)
+
+
+def benchmark_vote(args):
+    """Compare post_proc.vote with the original pairwise implementation."""
+    run("vote", post_proc.vote, vote_reference, random_vote_input, args)
+
+
+def benchmark_rot_rad(args):
+    """Compare post_proc.get_rot_rad with the original scikit-learn PCA implementation."""
+    print(
+        "import time: post_proc %.0f ms, sklearn.decomposition %.0f ms"
+        % (
+            import_time("horizon_net.misc.post_proc") * 1000,
+            import_time("sklearn.decomposition") * 1000,
+        )
+    )
+    run(
+        "get_rot_rad",
+        post_proc.get_rot_rad,
+        get_rot_rad_reference,
+        random_rot_rad_input,
+        args,
+        _same_rotation(args.atol),
+    )
+
+
+def benchmark_polygon(args):
+    """Compare post_proc.is_simple_polygon with shapely Polygon.is_valid."""
+    print(
+        "import time: post_proc %.0f ms, shapely.geometry %.0f ms"
+        % (
+            import_time("horizon_net.misc.post_proc") * 1000,
+            import_time("shapely.geometry") * 1000,
+        )
+    )
+    run(
+        "is_simple_polygon",
+        post_proc.is_simple_polygon,
+        is_valid_polygon_reference,
+        random_polygon_input,
+        args,
+    )
+
+
+def _setup_parser():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    common_parser = argparse.ArgumentParser(add_help=False)
+    common_parser.add_argument(
+        "--n_cases", type=int, default=10000, help="Number of random inputs checked."
+    )
+    common_parser.add_argument(
+        "--seed", type=int, default=0, help="Seed of the random inputs."
+    )
+    common_parser.add_argument(
+        "--repeats", type=int, default=20, help="Number of timed calls."
+    )
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    vote_parser = subparsers.add_parser(
+        "vote", parents=[common_parser], help=benchmark_vote.__doc__
+    )
+    vote_parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[64, 256, 1024],
+        help="Numbers of values of the timed inputs.",
+    )
+    vote_parser.set_defaults(func=benchmark_vote)
+
+    rot_rad_parser = subparsers.add_parser(
+        "rot_rad", parents=[common_parser], help=benchmark_rot_rad.__doc__
+    )
+    rot_rad_parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[4, 8, 16],
+        help="Numbers of walls of the timed rooms.",
+    )
+    rot_rad_parser.add_argument(
+        "--atol",
+        type=float,
+        default=1e-6,
+        help="Largest difference of the rotations in degrees.",
+    )
+    rot_rad_parser.set_defaults(func=benchmark_rot_rad)
+
+    polygon_parser = subparsers.add_parser(
+        "polygon", parents=[common_parser], help=benchmark_polygon.__doc__
+    )
+    polygon_parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[4, 8, 16, 32],
+        help="Numbers of walls of the timed layouts.",
+    )
+    polygon_parser.set_defaults(func=benchmark_polygon)
+    return parser
+
+
+if __name__ == "__main__":
+    parser = _setup_parser()
+    args = parser.parse_args()
+    args.func(args)
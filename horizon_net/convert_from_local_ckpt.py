@@ -14,25 +14,243 @@ Example usage as a script:
 It will convert a model resnet50_rnn__zind.pth to a torchscript model
 horizonNet.pt:
   horizon_net/horizonNet.pt
-"""
 
+To export an int8 model instead:
+
+  python convert_from_local_ckpt.py --quantize
+
+The encoder is quantized statically, calibrated on the images matching
+--calibration_glob, and the LSTM and linear layers are quantized dynamically.
+It will be saved to:
+  horizon_net/horizonNet_int8.pt
+
+To export an ONNX model, to run with ONNX Runtime, instead:
+
+  python convert_from_local_ckpt.py --onnx
+
+It will be saved to:
+  horizon_net/horizonNet.onnx
+
+To export a model running its convolutions in channels_last memory format:
+
+  python convert_from_local_ckpt.py --channels_last
+
+It will be saved to:
+  horizon_net/horizonNet_cl.pt
+
+To export a model with the BatchNorm layers folded into the convolutions:
+
+  python convert_from_local_ckpt.py --fuse_bn
+
+The outputs of the fused model are checked against the checkpoint on the
+--calibration_glob images before it is saved to:
+  horizon_net/horizonNet_fused.pt
+
+To export a frozen torchscript model:
+
+  python convert_from_local_ckpt.py --freeze
+
+It will be saved to:
+  horizon_net/horizonNet_frozen.pt
+
+To export every variant above, check them against the checkpoint and rank them
+by latency on the current host:
+
+  python convert_from_local_ckpt.py --all
+
+The outputs of each variant are compared with the eager model on the
+--calibration_glob images, and each variant is timed on this host. The ranking
+is added, under the name of the host, to:
+  horizon_net/variants_manifest.json
+HorizonNet(variant="best") then loads the fastest variant within the tolerances
+--max_bon_diff and --max_cor_diff of the host it runs on.
+
+The torchscript float32, channels_last, fused and frozen models keep the convolutions
+padded with LR_PAD as in the checkpoint. Use --convert_lr_pad to run them as LRPadConv2d,
+see model.convert_lr_pad, which gives the same outputs without copying the padded input
+of every convolution but measured slower on a single CPU core.
+"""
 import argparse
+import copy
+import glob
+import inspect
+import json
+import os
 from pathlib import Path
+import time
 
 from misc import utils
-from model import HorizonNet
+from model import (
+    convert_lr_pad,
+    export_onnx,
+    fuse_conv_bn,
+    HorizonNet,
+    to_channels_last,
+)
+import numpy as np
+from PIL import Image
 import torch
+import torch.nn as nn
 
 SCRIPTED_MODEL_FILENAME = "horizonNet.pt"
+QUANTIZED_MODEL_FILENAME = "horizonNet_int8.pt"
+ONNX_MODEL_FILENAME = "horizonNet.onnx"
+CHANNELS_LAST_MODEL_FILENAME = "horizonNet_cl.pt"
+FUSED_MODEL_FILENAME = "horizonNet_fused.pt"
+FROZEN_MODEL_FILENAME = "horizonNet_frozen.pt"
+MANIFEST_FILENAME = "variants_manifest.json"
+# Backend, variant name in HorizonNet and artifact of each model exported by --all
+ALL_VARIANTS = [
+    ("torchscript", "float32", SCRIPTED_MODEL_FILENAME),
+    ("torchscript", "frozen", FROZEN_MODEL_FILENAME),
+    ("torchscript", "fused", FUSED_MODEL_FILENAME),
+    ("torchscript", "int8", QUANTIZED_MODEL_FILENAME),
+    ("torchscript", "channels_last", CHANNELS_LAST_MODEL_FILENAME),
+    ("onnxruntime", "float32", ONNX_MODEL_FILENAME),
+]
+# Largest absolute difference of the outputs allowed by check_outputs
+FUSED_OUTPUT_ATOL = 1e-4
+# Also set by horizonnet_reconstruction.py before loading the int8 model
+QUANTIZED_ENGINE = "fbgemm"
 PROJECT_ROOT = Path(__file__).resolve().parent
 MODEL_CHECKPOINT_PATH = PROJECT_ROOT / "ckpt"
 SCRIPTED_MODEL_PATH = PROJECT_ROOT
+CALIBRATION_GLOB = str(PROJECT_ROOT / "assets" / "preprocessed" / "*_rgb.png")
 
 
 def main(args):
     """Load a checkpoint and save to a torchscript model."""
     model = load_model_from_checkpoint(args.ckpt_name)
-    save_model_to_torchscript(model, SCRIPTED_MODEL_PATH)
+    if args.all:
+        export_all(model, args)
+        return
+    if args.onnx:
+        filename = args.staged_model_name or ONNX_MODEL_FILENAME
+        export_onnx(model, SCRIPTED_MODEL_PATH / filename)
+        return
+    filename = args.staged_model_name or SCRIPTED_MODEL_FILENAME
+    if args.quantize:
+        calibration_images = load_calibration_images(args.calibration_glob)
+        model = quantize_model(model, calibration_images)
+        filename = args.staged_model_name or QUANTIZED_MODEL_FILENAME
+    elif args.convert_lr_pad:
+        model = convert_lr_pad(model)
+    if args.fuse_bn:
+        reference = copy.deepcopy(model)
+        model = fuse_conv_bn(model)
+        check_outputs(reference, model, load_calibration_images(args.calibration_glob))
+        filename = args.staged_model_name or FUSED_MODEL_FILENAME
+    if args.channels_last:
+        model = to_channels_last(model)
+        filename = args.staged_model_name or CHANNELS_LAST_MODEL_FILENAME
+    if args.freeze:
+        filename = args.staged_model_name or FROZEN_MODEL_FILENAME
+    save_model_to_torchscript(model, SCRIPTED_MODEL_PATH, filename, args.freeze)
+
+
+def export_all(model, args):
+    """Export every variant of ALL_VARIANTS, check, time and rank them on this host."""
+    calibration_images = load_calibration_images(args.calibration_glob)
+    converted = convert_lr_pad(copy.deepcopy(model)) if args.convert_lr_pad else model
+    for backend, variant, filename in ALL_VARIANTS:
+        print("Exporting %s %s to %s" % (backend, variant, filename))
+        if backend == "onnxruntime":
+            export_onnx(model, SCRIPTED_MODEL_PATH / filename)
+        elif variant == "int8":
+            quantized = quantize_model(model, calibration_images)
+            save_model_to_torchscript(quantized, SCRIPTED_MODEL_PATH, filename)
+        elif variant == "fused":
+            fused = fuse_conv_bn(copy.deepcopy(converted))
+            check_outputs(converted, fused, calibration_images)
+            save_model_to_torchscript(fused, SCRIPTED_MODEL_PATH, filename)
+        elif variant == "channels_last":
+            channels_last = to_channels_last(copy.deepcopy(converted))
+            save_model_to_torchscript(channels_last, SCRIPTED_MODEL_PATH, filename)
+        else:
+            freeze = variant == "frozen"
+            save_model_to_torchscript(converted, SCRIPTED_MODEL_PATH, filename, freeze)
+
+    # Images in the uint8 B x H x W x C layout taken by the exported models
+    images = (calibration_images * 255).round().to(torch.uint8)
+    images = images.permute(0, 2, 3, 1).contiguous()
+    ranking = rank_variants(model, images, args.max_bon_diff, args.max_cor_diff)
+    path = SCRIPTED_MODEL_PATH / MANIFEST_FILENAME
+    manifest = {"hosts": {}}
+    if os.path.isfile(path):
+        with open(path) as f:
+            manifest = json.load(f)
+    manifest["hosts"][utils.host_id()] = {
+        "checkpoint": args.ckpt_name,
+        "max_bon_diff": args.max_bon_diff,
+        "max_cor_diff": args.max_cor_diff,
+        "variants": ranking,
+    }
+    with open(path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    for entry in ranking:
+        print(
+            "%-11s %-13s: %7.1f ms, bon diff %.2e, cor diff %.2e%s"
+            % (
+                entry["backend"],
+                entry["variant"],
+                entry["latency_ms"],
+                entry["max_bon_diff"],
+                entry["max_cor_diff"],
+                "" if entry["within_tolerance"] else " (out of tolerance)",
+            )
+        )
+    print("Ranking of %s written to %s" % (utils.host_id(), path))
+
+
+def _load_runner(backend, model_file):
+    """Return a function predicting bon, cor with an exported model."""
+    if backend == "onnxruntime":
+        import onnxruntime as ort
+
+        session = ort.InferenceSession(
+            str(model_file), providers=["CPUExecutionProvider"]
+        )
+        return lambda x: [
+            torch.from_numpy(y) for y in session.run(None, {"x": x.numpy()})
+        ]
+    return torch.jit.load(str(model_file))
+
+
+def rank_variants(model, images, max_bon_diff, max_cor_diff, repeats=5):
+    """Compare the exported variants with the eager model and sort them by latency.
+
+    Variants within both tolerances come first, each group is sorted by the median
+    latency of predicting one image.
+    """
+    ranking = []
+    with torch.no_grad():
+        expected = [model(x[None]) for x in images]
+        for backend, variant, filename in ALL_VARIANTS:
+            runner = _load_runner(backend, SCRIPTED_MODEL_PATH / filename)
+            bon_diff = cor_diff = 0.0
+            for x, (bon, cor) in zip(images, expected):
+                y_bon, y_cor = runner(x[None])
+                bon_diff = max(bon_diff, (y_bon - bon).abs().max().item())
+                cor_diff = max(
+                    cor_diff, (y_cor.sigmoid() - cor.sigmoid()).abs().max().item()
+                )
+            latencies = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                runner(images[:1])
+                latencies.append(time.perf_counter() - start)
+            ranking.append(
+                {
+                    "backend": backend,
+                    "variant": variant,
+                    "latency_ms": float(np.median(latencies)) * 1000,
+                    "max_bon_diff": bon_diff,
+                    "max_cor_diff": cor_diff,
+                    "within_tolerance": bon_diff <= max_bon_diff
+                    and cor_diff <= max_cor_diff,
+                }
+            )
+    return sorted(ranking, key=lambda e: (not e["within_tolerance"], e["latency_ms"]))
 
 
 def load_model_from_checkpoint(name):
@@ -43,14 +261,74 @@ def load_model_from_checkpoint(name):
     return model
 
 
-def save_model_to_torchscript(model, directory):
-    """Save a model to a torchscript model."""
+def save_model_to_torchscript(
+    model, directory, filename=SCRIPTED_MODEL_FILENAME, freeze=False
+):
+    """Save a model to a torchscript model, optionally frozen."""
     scripted_model = torch.jit.script(model)
-    path = Path(directory) / SCRIPTED_MODEL_FILENAME
+    if freeze:
+        # Keep the attributes read by HorizonNet when it loads the model
+        scripted_model = torch.jit.freeze(
+            scripted_model.eval(), preserved_attrs=["forward_rolled", "accepts_uint8"]
+        )
+    path = Path(directory) / filename
     scripted_model.save(path)
     # print(scripted_model.code)
 
 
+def load_calibration_images(image_glob):
+    """Load aligned panoramas as a N x 3 x 512 x 1024 tensor scaled to [0, 1]."""
+    paths = sorted(glob.glob(image_glob))
+    if not paths:
+        raise FileNotFoundError(f"No calibration image matches {image_glob}")
+    images = []
+    for path in paths:
+        img_pil = Image.open(path).convert("RGB").resize((1024, 512), Image.BICUBIC)
+        images.append(np.array(img_pil).transpose([2, 0, 1]) / 255)
+    return torch.FloatTensor(np.stack(images))
+
+
+def quantize_model(model, calibration_images):
+    """Quantize a model to int8.
+
+    The encoder is quantized with post-training static quantization, using the
+    calibration images to observe the activation ranges. The LSTM and linear
+    layers of the head are quantized dynamically.
+    """
+    from torch.ao.quantization import get_default_qconfig, quantize_dynamic
+    from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+    torch.backends.quantized.engine = QUANTIZED_ENGINE
+    model = copy.deepcopy(model).eval()
+
+    qconfig_dict = {"": get_default_qconfig(QUANTIZED_ENGINE)}
+    kwargs = {}
+    # prepare_fx takes the example inputs of the model since torch 1.13
+    if "example_inputs" in inspect.signature(prepare_fx).parameters:
+        kwargs["example_inputs"] = (model._prepare_x(calibration_images[:1]),)
+    encoder = prepare_fx(model.feature_extractor, qconfig_dict, **kwargs)
+    with torch.no_grad():
+        for x in calibration_images:
+            encoder(model._prepare_x(x[None]))
+    model.feature_extractor = convert_fx(encoder)
+
+    return quantize_dynamic(model, {nn.LSTM, nn.Linear}, dtype=torch.qint8)
+
+
+def check_outputs(reference, model, images, atol=FUSED_OUTPUT_ATOL):
+    """Raise a ValueError if model and reference predict different outputs."""
+    with torch.no_grad():
+        for x in images:
+            for name, expected, output in zip(
+                ["bon", "cor"], reference(x[None]), model(x[None])
+            ):
+                diff = (expected - output).abs().max().item()
+                if diff > atol:
+                    raise ValueError(
+                        f"Max abs difference of {name} is {diff:.2e} > {atol:.2e}"
+                    )
+
+
 def _setup_parser():
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument(
@@ -63,8 +341,67 @@ def _setup_parser():
     parser.add_argument(
         "--staged_model_name",
         type=str,
-        default=SCRIPTED_MODEL_FILENAME,
-        help=f"Name to give the staged model artifact. Default is '{SCRIPTED_MODEL_FILENAME}'.",
+        default=None,
+        help=(
+            f"Name to give the staged model artifact. Default is {SCRIPTED_MODEL_FILENAME!r}, "
+            f"{QUANTIZED_MODEL_FILENAME!r} with --quantize, {ONNX_MODEL_FILENAME!r} with --onnx, "
+            f"{CHANNELS_LAST_MODEL_FILENAME!r} with --channels_last, "
+            f"{FUSED_MODEL_FILENAME!r} with --fuse_bn or {FROZEN_MODEL_FILENAME!r} with --freeze."
+        ),
+    )
+    variant = parser.add_mutually_exclusive_group()
+    variant.add_argument(
+        "--quantize",
+        action="store_true",
+        help="Export an int8 model instead of a float32 one.",
+    )
+    variant.add_argument(
+        "--onnx",
+        action="store_true",
+        help="Export an ONNX model instead of a torchscript one.",
+    )
+    variant.add_argument(
+        "--channels_last",
+        action="store_true",
+        help="Export a model using the channels_last memory format.",
+    )
+    variant.add_argument(
+        "--fuse_bn",
+        action="store_true",
+        help="Export a model with the BatchNorm layers folded into the convolutions.",
+    )
+    variant.add_argument(
+        "--freeze",
+        action="store_true",
+        help="Export a frozen torchscript model.",
+    )
+    variant.add_argument(
+        "--all",
+        action="store_true",
+        help=f"Export every variant and rank them on this host in {MANIFEST_FILENAME!r}.",
+    )
+    parser.add_argument(
+        "--convert_lr_pad",
+        action="store_true",
+        help="Convert the LR_PAD wrapped convolutions to LRPadConv2d.",
+    )
+    parser.add_argument(
+        "--calibration_glob",
+        type=str,
+        default=CALIBRATION_GLOB,
+        help="Aligned panoramas used to calibrate the quantized encoder and to check the exported models.",
+    )
+    parser.add_argument(
+        "--max_bon_diff",
+        type=float,
+        default=0.02,
+        help="Largest absolute difference of the boundaries with the checkpoint for a variant ranked by --all.",
+    )
+    parser.add_argument(
+        "--max_cor_diff",
+        type=float,
+        default=0.05,
+        help="Largest absolute difference of the corner probabilities with the checkpoint for a variant ranked by --all.",
     )
     return parser
 
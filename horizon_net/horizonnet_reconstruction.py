@@ -13,26 +13,96 @@ Example usage as a script:
 When called directly, the module will also return a .json file specified in OUTPUT_FILE
 """
 import argparse
+import contextlib
 import json
 import os
 from pathlib import Path
 import sys
-from typing import Union
-from urllib import request
+import time
+from typing import List, Optional, Union
 
 import numpy as np
 from PIL import Image
 from scipy.ndimage.filters import maximum_filter
-from shapely.geometry import Polygon
 import torch
 
+from .artifacts import ArtifactStore
 from .misc import post_proc
+from .misc.utils import host_id
 
 STAGED_MODEL_DIRNAME = Path(__file__).resolve().parent
 IMAGE_DIRNAME = Path(__file__).resolve().parent
-MODEL_FILE = "/tmp/horizonNet.pt"
+MODEL_DIRNAME = os.environ.get("HORIZONNET_MODEL_DIR", "/tmp")
 OUTPUT_FILE = "assets/inferenced/torchscript_test.json"
-MODEL_URL = "https://horizonnetmodel.s3.eu-west-2.amazonaws.com/horizonNet.pt"
+# An https URL, or e.g. file:///path/to/artifacts/ to run offline
+MODEL_BUCKET_URL = os.environ.get(
+    "HORIZONNET_MODEL_URL", "https://horizonnetmodel.s3.eu-west-2.amazonaws.com/"
+)
+# sha256 of the artifacts, the ones missing are read from the cache or from
+# <filename>.sha256 in MODEL_BUCKET_URL. horizonNet.pt is the oid of its LFS pointer
+MODEL_CHECKSUMS = {
+    "horizonNet.pt": "009de412a2be086798ac6e1195c2fdd7f20bd43e6bbd0dfb9d92d6278d842696",
+}
+ARTIFACTS = ArtifactStore(MODEL_BUCKET_URL, MODEL_DIRNAME, MODEL_CHECKSUMS)
+# Thread and batch settings written by tune_threads.py
+INFERENCE_CONFIG_FILE = os.environ.get(
+    "HORIZONNET_INFERENCE_CONFIG", str(STAGED_MODEL_DIRNAME / "inference_config.json")
+)
+DEFAULT_BATCH_SIZE = 8
+# Width x height of the images fed to the model, and in preview mode, where the
+# encoder runs on 4x less pixels and the outputs still have 1024 columns
+IMAGE_SIZE = (1024, 512)
+PREVIEW_IMAGE_SIZE = (512, 256)
+# Precisions of the model forward pass, the post-processing always runs in float32
+PRECISIONS = {"float32": torch.float32, "bfloat16": torch.bfloat16}
+# Artifacts exported by convert_from_local_ckpt.py, by backend and variant name
+MODEL_VARIANTS = {
+    "torchscript": {
+        "float32": "horizonNet.pt",
+        "int8": "horizonNet_int8.pt",
+        "channels_last": "horizonNet_cl.pt",
+        "fused": "horizonNet_fused.pt",
+        "frozen": "horizonNet_frozen.pt",
+        # Smaller backbone or head, the first stage of HorizonNetCascade
+        "small": "horizonNet_small.pt",
+    },
+    "onnxruntime": {
+        "float32": "horizonNet.onnx",
+    },
+}
+# Engine of the quantized kernels of the int8 model, as in convert_from_local_ckpt.py
+QUANTIZED_ENGINE = "fbgemm"
+# Settings of HorizonNetCascade: layouts of the small model scoring below threshold
+# with layout_confidence are predicted again by the large model
+DEFAULT_CASCADE = {
+    "small": {"variant": "small"},
+    "large": {"variant": "float32"},
+    "threshold": 0.5,
+    "spread_weight": 2.0,
+}
+# Variants ranked by latency on each host by convert_from_local_ckpt.py --all
+VARIANTS_MANIFEST_FILE = os.environ.get(
+    "HORIZONNET_VARIANTS_MANIFEST",
+    str(STAGED_MODEL_DIRNAME / "variants_manifest.json"),
+)
+# Variant name loading the first variant of the manifest ranking of the host
+BEST_VARIANT = "best"
+# Test-time augmentation used when HorizonNet is created with tta=True. Rotations
+# are evenly spaced around the panorama, flip_weight and rotate_weight are the
+# weights of the augmented predictions when merged with the original one. With
+# mode "input" every rotation is encoded by the backbone, with mode "feature" the
+# backbone runs once and its feature maps are rolled instead.
+DEFAULT_TTA = {
+    "flip": True,
+    "rotate": 3,
+    "flip_weight": 1.0,
+    "rotate_weight": 1.0,
+    "mode": "input",
+}
+TTA_MODES = ["input", "feature"]
+# Horizontal stride of the last encoder block, rotations are rounded to a multiple of it
+# so that they are an exact shift of every feature map
+ENCODER_STRIDE = 32
 
 
 def find_N_peaks(signal, r=29, min_v=0.05, N=None):
@@ -47,37 +117,227 @@ def find_N_peaks(signal, r=29, min_v=0.05, N=None):
     return pk_loc, signal[pk_loc]
 
 
-def augment(x_img, flip, rotate):
-    x_img = x_img.numpy()
+def augment(x_img, flip, rotate, dim=-1):
+    """Stack the flipped and horizontally rotated copies of a batch of images.
+
+    The augmented copies are concatenated along the batch dimension, so that the
+    whole set can be sent to the model in a single forward pass. dim is the width
+    dimension of x_img, 2 for B x H x W x C images.
+    """
     aug_type = [""]
     x_imgs_augmented = [x_img]
     if flip:
         aug_type.append("flip")
-        x_imgs_augmented.append(np.flip(x_img, axis=-1))
+        x_imgs_augmented.append(torch.flip(x_img, dims=[dim]))
     for shift_p in rotate:
-        shift = int(round(shift_p * x_img.shape[-1]))
+        shift = int(round(shift_p * x_img.shape[dim]))
         aug_type.append("rotate %d" % shift)
-        x_imgs_augmented.append(np.roll(x_img, shift, axis=-1))
-    return torch.FloatTensor(np.concatenate(x_imgs_augmented, 0)), aug_type
+        x_imgs_augmented.append(torch.roll(x_img, shift, dims=dim))
+    return torch.cat(x_imgs_augmented, 0), aug_type
 
 
-def augment_undo(x_imgs_augmented, aug_type):
-    x_imgs_augmented = x_imgs_augmented.cpu().numpy()
+def augment_undo(x_imgs_augmented, aug_type, scale=1):
+    """Undo augment on the model outputs, returns a tensor of shape len(aug_type) x B x ...
+
+    scale is the number of output columns per input column.
+    """
     sz = x_imgs_augmented.shape[0] // len(aug_type)
     x_imgs = []
     for i, aug in enumerate(aug_type):
         x_img = x_imgs_augmented[i * sz : (i + 1) * sz]
-        if aug == "flip":
-            x_imgs.append(np.flip(x_img, axis=-1))
+        if aug == "flip" or aug.startswith("flip rolled"):
+            x_imgs.append(torch.flip(x_img, dims=[-1]))
         elif aug.startswith("rotate"):
-            shift = int(aug.split()[-1])
-            x_imgs.append(np.roll(x_img, -shift, axis=-1))
-        elif aug == "":
+            shift = int(aug.split()[-1]) * scale
+            x_imgs.append(torch.roll(x_img, -shift, dims=-1))
+        elif aug == "" or aug.startswith("rolled"):
+            # "rolled" outputs are already rolled back by HorizonNet.forward_rolled
             x_imgs.append(x_img)
         else:
             raise NotImplementedError()
 
-    return np.array(x_imgs)
+    return torch.stack(x_imgs)
+
+
+def augment_merge(x_imgs, aug_type, tta):
+    """Weighted mean of the output of augment_undo over the augmentations."""
+    weights = []
+    for aug in aug_type:
+        weight = 1.0
+        if aug.startswith("flip"):
+            weight *= tta["flip_weight"]
+        if aug.startswith("rotate") or "rolled" in aug:
+            weight *= tta["rotate_weight"]
+        weights.append(weight)
+    weights = torch.tensor(weights, dtype=x_imgs.dtype, device=x_imgs.device)
+    weights = weights.view(-1, *([1] * (x_imgs.dim() - 1)))
+    return (x_imgs * weights).sum(0) / weights.sum()
+
+
+def select_variant(path=None):
+    """Return the backend and variant ranked fastest within tolerance on this host.
+
+    Falls back to the torchscript float32 model if the manifest has no ranking
+    for this host.
+    """
+    path = path or VARIANTS_MANIFEST_FILE
+    if os.path.isfile(path):
+        with open(path) as f:
+            hosts = json.load(f)["hosts"]
+        for entry in hosts.get(host_id(), {}).get("variants", []):
+            if entry["within_tolerance"]:
+                return entry["backend"], entry["variant"]
+    print("No variant ranked for %s in %s, using float32" % (host_id(), path))
+    return "torchscript", "float32"
+
+
+def layout_confidence(stats, spread_weight=DEFAULT_CASCADE["spread_weight"]):
+    """Score in [0, 1] the layout of the post-processing statistics of one image.
+
+    The score is the mean prominence of the corner peaks, lowered by the relative
+    spread of the ceiling heights of the columns around the refined one, and 0 if
+    the general layout was self-intersecting and replaced by a cuboid.
+    """
+    if stats["cuboid_fallback"]:
+        return 0.0
+    return stats["peak_prominence"] * max(0.0, 1 - spread_weight * stats["z1_spread"])
+
+
+def _tta_config(tta):
+    """Build the test-time augmentation settings from the tta option of HorizonNet."""
+    if not tta:
+        return dict(DEFAULT_TTA, flip=False, rotate=0)
+    config = dict(DEFAULT_TTA)
+    if isinstance(tta, dict):
+        unknown = set(tta) - set(DEFAULT_TTA)
+        if unknown:
+            raise ValueError("Unknown tta options: %s" % ", ".join(sorted(unknown)))
+        config.update(tta)
+    if config["rotate"] < 0:
+        raise ValueError("The number of tta rotations must be non-negative")
+    if config["mode"] not in TTA_MODES:
+        raise ValueError("tta mode must be one of %s" % ", ".join(TTA_MODES))
+    return config
+
+
+def _tta_rotate(n_rotate, W=1024):
+    """Evenly spaced rotations, as fractions of the width, on the encoder stride grid."""
+    n_steps = W // ENCODER_STRIDE
+    return [
+        int(round(k * n_steps / (n_rotate + 1))) / n_steps
+        for k in range(1, n_rotate + 1)
+    ]
+
+
+def load_inference_config(path: Optional[str] = None):
+    """Read the settings written by tune_threads.py, empty if there are none."""
+    path = path or INFERENCE_CONFIG_FILE
+    if not os.path.isfile(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def apply_inference_config(config: dict):
+    """Set the torch thread counts of the config, if it has any.
+
+    The inter-op thread count can only be set before torch runs any parallel work,
+    so the config should be applied at startup, before the model is loaded.
+    """
+    if "intra_op_threads" in config:
+        torch.set_num_threads(config["intra_op_threads"])
+    if "inter_op_threads" in config:
+        if torch.get_num_interop_threads() != config["inter_op_threads"]:
+            try:
+                torch.set_num_interop_threads(config["inter_op_threads"])
+            except RuntimeError as exception:
+                print("Could not set inter-op threads:", exception, file=sys.stderr)
+
+
+def _uint8_to_float(x):
+    """Convert B x H x W x C uint8 images to B x C x H x W floats in [0, 1]."""
+    return x.permute(0, 3, 1, 2).float() / 255
+
+
+class TorchScriptBackend:
+    """Run a TorchScript model exported by convert_from_local_ckpt.py.
+
+    The backends take batches of B x H x W x C uint8 images.
+    """
+
+    def __init__(self, model_file: str):
+        self.model = torch.jit.load(model_file)
+        self.dtype = torch.float32
+        # Models exported before the uint8 input contract need float images
+        self.accepts_uint8 = getattr(self.model, "accepts_uint8", False)
+        if hasattr(self.model, "forward_rolled"):
+            self.forward_rolled = self._forward_rolled
+
+    def __call__(self, x):
+        """Return the float32 y_bon and y_cor outputs of a batch of images."""
+        if not self.accepts_uint8:
+            x = _uint8_to_float(x)
+        with self._autocast():
+            y_bon_, y_cor_ = self.model(x)
+        return y_bon_.float(), y_cor_.float()
+
+    def _forward_rolled(self, x, shifts: List[int]):
+        if not self.accepts_uint8:
+            x = _uint8_to_float(x)
+        with self._autocast():
+            y_bon_, y_cor_ = self.model.forward_rolled(x, shifts)
+        return y_bon_.float(), y_cor_.float()
+
+    def _autocast(self):
+        # torch.autocast refuses float32 even when disabled, so the float32 forward
+        # pass runs without any autocast context
+        if self.dtype is torch.float32:
+            return contextlib.nullcontext()
+        return torch.autocast("cpu", dtype=self.dtype)
+
+    def set_precision(self, precision: str):
+        """Run the forward pass under CPU autocast with a reduced precision dtype."""
+        if precision not in PRECISIONS:
+            raise ValueError(
+                "Unknown precision %s, expected one of %s"
+                % (precision, ", ".join(PRECISIONS))
+            )
+        self.dtype = PRECISIONS[precision]
+
+    def freeze(self):
+        """Freeze the model and apply the TorchScript inference optimizations."""
+        other_methods = ["forward_rolled"] if hasattr(self, "forward_rolled") else []
+        model = torch.jit.freeze(self.model.eval(), preserved_attrs=other_methods)
+        self.model = torch.jit.optimize_for_inference(model, other_methods)
+
+
+class OnnxRuntimeBackend:
+    """Run an ONNX model exported by convert_from_local_ckpt.py with ONNX Runtime on CPU."""
+
+    def __init__(self, model_file: str):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(
+            model_file, options, providers=["CPUExecutionProvider"]
+        )
+        self.input_name = self.session.get_inputs()[0].name
+        # Models exported before the uint8 input contract need float images
+        self.accepts_uint8 = self.session.get_inputs()[0].type == "tensor(uint8)"
+
+    def __call__(self, x):
+        """Return the y_bon and y_cor outputs of a batch of images as tensors."""
+        if not self.accepts_uint8:
+            x = _uint8_to_float(x)
+        y_bon_, y_cor_ = self.session.run(None, {self.input_name: x.cpu().numpy()})
+        return torch.from_numpy(y_bon_), torch.from_numpy(y_cor_)
+
+
+BACKENDS = {
+    "torchscript": TorchScriptBackend,
+    "onnxruntime": OnnxRuntimeBackend,
+}
 
 
 class HorizonNet:
@@ -85,24 +345,124 @@ class HorizonNet:
 
     Loads the pretrained torchscript deployed memory from a public s3 bucket and
     executes a prediction over new unseen data.
+
+    Parameters
+    ----------
+    variant : str
+        Name of the exported model to load, one of MODEL_VARIANTS[backend]. It is
+        downloaded from the s3 bucket to the cache in MODEL_DIRNAME and its
+        checksum verified, if it is not there yet.
+        "best" loads the fastest variant of this host in VARIANTS_MANIFEST_FILE,
+        and its backend instead of the backend argument
+    model_file : str, optional
+        Path of an exported model to load instead of the variant
+    backend : str
+        Runtime executing the model, one of BACKENDS. The post-processing is the
+        same for every backend
+    tta : bool or dict
+        Test-time augmentation. False disables it, True uses DEFAULT_TTA and a
+        dict overrides some of the DEFAULT_TTA settings. All the augmented copies
+        of a batch are predicted in the same forward pass. The "feature" mode
+        needs a model exported with HorizonNet.forward_rolled.
+    freeze : bool
+        Freeze the TorchScript model and optimize it for inference when loaded
+    warmup : int
+        Number of predictions run on a synthetic 512 x 1024 image before the
+        instance is marked ready, so that the first request does not pay for the
+        TorchScript profiling runs
+    config : dict, optional
+        Thread and batch settings, read from INFERENCE_CONFIG_FILE if not given
+    precision : str
+        Precision of the forward pass, one of PRECISIONS. "bfloat16" runs the
+        TorchScript model under CPU autocast, check its accuracy with parity.py
+        before enabling it on a new CPU type
+    preview : bool
+        Run the model on PREVIEW_IMAGE_SIZE images, for about 4x less compute and
+        a lower accuracy, see parity.py. The outputs are still predicted at 1024
+        columns so the post-processing is unchanged. Needs a torchscript model
+        exported with preview support, and is not available with the "feature"
+        tta mode
     """
 
-    def __init__(self):
-        if os.path.isfile(MODEL_FILE) is False:
-            print("downloading", os.getcwd())
-            _ = request.urlretrieve(MODEL_URL, MODEL_FILE)
-            print("downloaded", os.getcwd(), os.listdir())
-        self.model = torch.jit.load(MODEL_FILE)
+    def __init__(
+        self,
+        variant: str = "float32",
+        model_file: Optional[str] = None,
+        backend: str = "torchscript",
+        tta: Union[bool, dict] = False,
+        freeze: bool = False,
+        warmup: int = 0,
+        config: Optional[dict] = None,
+        precision: str = "float32",
+        preview: bool = False,
+    ):
+        self.ready = False
+        if config is None:
+            config = load_inference_config()
+        apply_inference_config(config)
+        self.batch_size = config.get("batch_size", DEFAULT_BATCH_SIZE)
+        if model_file is None and variant == BEST_VARIANT:
+            backend, variant = select_variant()
+        if backend not in BACKENDS:
+            raise ValueError(
+                "Unknown backend %s, expected one of %s"
+                % (backend, ", ".join(BACKENDS))
+            )
+        self.tta = _tta_config(tta)
+        self.tta_rotate = _tta_rotate(self.tta["rotate"])
+        if preview and (backend != "torchscript" or self.tta["mode"] == "feature"):
+            raise ValueError(
+                "preview is only supported by the torchscript backend with tta "
+                "mode 'input'"
+            )
+        self.image_size = PREVIEW_IMAGE_SIZE if preview else IMAGE_SIZE
+        if model_file is None:
+            model_file = _download_model(backend, variant)
+        if backend == "torchscript" and variant == "int8":
+            torch.backends.quantized.engine = QUANTIZED_ENGINE
+        self.backend = BACKENDS[backend](model_file)
+        rolled = hasattr(self.backend, "forward_rolled")
+        if self.tta["mode"] == "feature" and not rolled:
+            raise ValueError(
+                "tta mode 'feature' needs a torchscript model exported with "
+                "forward_rolled, re-export it with convert_from_local_ckpt.py"
+            )
+        if precision != "float32":
+            if not hasattr(self.backend, "set_precision"):
+                raise ValueError(
+                    "precision is only supported by the torchscript backend"
+                )
+            self.backend.set_precision(precision)
+        if freeze:
+            if not hasattr(self.backend, "freeze"):
+                raise ValueError("freeze is only supported by the torchscript backend")
+            self.backend.freeze()
+        self.warmup(warmup)
+        self.ready = True
 
     @torch.no_grad()
-    def predict(self, image: Union[str, Path, Image.Image]):
+    def warmup(self, n_runs: int = 1):
+        """Run the model and its test-time augmentation on a synthetic image."""
+        W, H = self.image_size
+        x = torch.zeros(1, H, W, 3, dtype=torch.uint8)
+        for _ in range(n_runs):
+            self._forward(x)
+
+    @torch.no_grad()
+    def predict(
+        self, image: Union[str, Path, Image.Image, np.ndarray], raw: bool = False
+    ):
         """Genetate new layout reconstruction on a new image using trained model
 
         Parameters
         ----------
         image : array_like
-            Can be either an image already loaded with PIL other the path
-            pointing to where that image is stored
+            Can be either an image already loaded with PIL, a H x W x C uint8
+            numpy array, other the path pointing to where that image is stored
+        raw : bool
+            Also return the outputs of the model: y_bon, the 2 x 1024 float32
+            ceiling and floor boundaries in radians, and y_cor, the 1024 float32
+            wall-wall corner probabilities
 
         Returns
         -------
@@ -110,75 +470,299 @@ class HorizonNet:
             Dictionary contains the predicted position of the corners as well
             location of the floor and ceiling for each column of the image
         """
-        # Load image
-        img_pil = image
-        if not isinstance(image, Image.Image):
-            img_pil = Image.open(image)
-        print(img_pil.size)
-        if img_pil.size != (1024, 512):
-            img_pil = img_pil.resize((1024, 512), Image.BICUBIC)
-        img_ori = np.array(img_pil)[..., :3].transpose([2, 0, 1]).copy()
-        x = torch.FloatTensor(np.array([img_ori / 255]))
-        H, W = tuple(x.shape[2:])
-
-        x, aug_type = augment(x, False, [])
-
-        y_bon_, y_cor_ = self.model(x)
-        y_bon_ = augment_undo(y_bon_.cpu(), aug_type).mean(0)
-        y_cor_ = augment_undo(torch.sigmoid(y_cor_).cpu(), aug_type).mean(0)
-
-        y_bon_ = (y_bon_[0] / np.pi + 0.5) * H - 0.5
-        y_bon_[0] = np.clip(y_bon_[0], 1, H / 2 - 1)
-        y_bon_[1] = np.clip(y_bon_[1], H / 2 + 1, H - 2)
-        y_cor_ = y_cor_[0, 0]
-
-        # Init floor/ceil plane
-        z0 = 50
-        _, z1 = post_proc.np_refine_by_fix_z(*y_bon_, z0)
-
-        min_v = 0.05
-        r = 0.05
-        r = int(round(W * r / 2))
-        force_cuboid = None
-        N = None
-        xs_ = find_N_peaks(y_cor_, r=r, min_v=min_v, N=N)[0]
-
-        cor, xy_cor = post_proc.gen_ww(
-            xs_, y_bon_[0], z0, tol=abs(0.16 * z1 / 1.6), force_cuboid=force_cuboid
-        )
-        if not force_cuboid:
-            # Check valid (for fear self-intersection)
-            xy2d = np.zeros((len(xy_cor), 2), np.float32)
-            for i in range(len(xy_cor)):
-                xy2d[i, xy_cor[i]["type"]] = xy_cor[i]["val"]
-                xy2d[i, xy_cor[i - 1]["type"]] = xy_cor[i - 1]["val"]
-            if not Polygon(xy2d).is_valid:
-                print(
-                    "Fail to generate valid general layout!! "
-                    "Generate cuboid as fallback.",
-                    file=sys.stderr,
-                )
-                xs_ = find_N_peaks(y_cor_, r=r, min_v=0, N=4)[0]
-                cor, xy_cor = post_proc.gen_ww(
-                    xs_, y_bon_[0], z0, tol=abs(0.16 * z1 / 1.6), force_cuboid=True
+        return self.predict_batch([image], batch_size=1, raw=raw)[0]
+
+    @torch.no_grad()
+    def predict_batch(
+        self,
+        images: List[Union[str, Path, Image.Image, np.ndarray]],
+        batch_size: Optional[int] = None,
+        stats: Optional[list] = None,
+        raw: bool = False,
+    ):
+        """Generate layout reconstructions for several images at once
+
+        Images are stacked into batches of ``batch_size`` so that the model runs
+        a single forward pass per batch instead of one per image.
+
+        Parameters
+        ----------
+        images : list
+            Images already loaded with PIL, H x W x C uint8 numpy arrays or paths
+            pointing to where they are stored
+        batch_size : int, optional
+            Maximum number of images sent to the model in one forward pass, the
+            batch size of the inference config by default. With test-time
+            augmentation each forward pass also holds their augmented copies
+        stats : list, optional
+            If given, the post-processing statistics of each image, scored by
+            layout_confidence, are appended to it
+        raw : bool
+            Also return the outputs of the model, see predict
+
+        Returns
+        -------
+        list of dict
+            One prediction dictionary per image, in the same order as ``images``,
+            with the same keys as the output of ``predict``
+        """
+        batch_size = batch_size or self.batch_size
+        if batch_size < 1:
+            raise ValueError("batch_size must be a positive integer")
+        predictions = []
+        for start in range(0, len(images), batch_size):
+            batch = [
+                _load_image(image, self.image_size)
+                for image in images[start : start + batch_size]
+            ]
+            # A single image is passed as a view, without copy
+            x = torch.from_numpy(batch[0][None] if len(batch) == 1 else np.stack(batch))
+
+            y_bon_, y_cor_, aug_type = self._forward(x)
+            # Post-process at the output resolution, 1024 columns even in preview
+            W = y_bon_.shape[-1]
+            H = W // 2
+            scale = W // x.shape[2]
+            y_bon_ = augment_undo(y_bon_, aug_type, scale)
+            y_bon_ = augment_merge(y_bon_, aug_type, self.tta)
+            y_cor_ = augment_undo(torch.sigmoid(y_cor_), aug_type, scale)
+            y_cor_ = augment_merge(y_cor_, aug_type, self.tta)
+            y_bon_, y_cor_ = y_bon_.cpu().numpy(), y_cor_.cpu().numpy()
+
+            for i in range(len(y_bon_)):
+                image_stats = {} if stats is not None else None
+                predictions.append(
+                    _post_process(y_bon_[i], y_cor_[i, 0], H, W, image_stats)
                 )
+                if raw:
+                    predictions[-1]["y_bon"] = y_bon_[i]
+                    predictions[-1]["y_cor"] = y_cor_[i, 0]
+                if stats is not None:
+                    stats.append(image_stats)
+        return predictions
+
+    def _forward(self, x):
+        """Run the model on x and its test-time augmented copies."""
+        if self.tta["mode"] == "feature":
+            W = x.shape[2]
+            x, aug_type = augment(x, self.tta["flip"], [], dim=2)
+            shifts = [0] + [int(round(shift_p * W)) for shift_p in self.tta_rotate]
+            y_bon_, y_cor_ = self.backend.forward_rolled(x, shifts)
+            aug_type = [
+                ("%s rolled %d" % (aug, shift)).strip() if shift else aug
+                for shift in shifts
+                for aug in aug_type
+            ]
+            return y_bon_, y_cor_, aug_type
+
+        x, aug_type = augment(x, self.tta["flip"], self.tta_rotate, dim=2)
+        y_bon_, y_cor_ = self.backend(x)
+        return y_bon_, y_cor_, aug_type
+
+
+def _download_model(backend, variant):
+    """Return the local path of a model variant, downloading it if needed."""
+    variants = MODEL_VARIANTS[backend]
+    if variant not in variants:
+        raise ValueError(
+            "Unknown %s model variant %s, expected one of %s"
+            % (backend, variant, ", ".join(variants))
+        )
+    return download_model_file(variants[variant])
+
+
+def download_model_file(filename):
+    """Return the local path of a model artifact, downloading it if needed."""
+    return ARTIFACTS.fetch(filename)
+
+
+def prefetch_model_file(filename):
+    """Download a model artifact in a background thread, see download_model_file."""
+    return ARTIFACTS.prefetch(filename)
 
-        # Expand with btn coory
-        cor = np.hstack([cor, post_proc.infer_coory(cor[:, 1], z1 - z0, z0)[:, None]])
 
-        # Collect corner position in equirectangular
-        cor_id = np.zeros((len(cor) * 2, 2), np.float32)
-        for j in range(len(cor)):
-            cor_id[j * 2] = cor[j, 0], cor[j, 1]
-            cor_id[j * 2 + 1] = cor[j, 0], cor[j, 2]
+def _load_image(image, size=IMAGE_SIZE):
+    """Load an image and return it as a contiguous uint8 array, resized to size."""
+    if isinstance(image, np.ndarray) and image.shape[:2] == size[::-1]:
+        return np.ascontiguousarray(image[..., :3], dtype=np.uint8)
+    img_pil = image
+    if isinstance(image, np.ndarray):
+        img_pil = Image.fromarray(image)
+    elif not isinstance(image, Image.Image):
+        img_pil = Image.open(image)
+    print(img_pil.size)
+    if img_pil.size != size:
+        img_pil = img_pil.resize(size, Image.BICUBIC)
+    return np.ascontiguousarray(np.array(img_pil)[..., :3])
+
+
+def _post_process(y_bon_, y_cor_, H, W, stats=None):
+    """Turn the boundary and corner outputs of one image into a prediction dictionary.
+
+    If stats is a dictionary, the prominence of the corner peaks, the spread of
+    the ceiling heights and whether the cuboid fallback fired are written to it.
+    """
+    y_bon_ = (y_bon_ / np.pi + 0.5) * H - 0.5
+    y_bon_[0] = np.clip(y_bon_[0], 1, H / 2 - 1)
+    y_bon_[1] = np.clip(y_bon_[1], H / 2 + 1, H - 2)
+
+    # Init floor/ceil plane
+    z0 = 50
+    _, z1 = post_proc.np_refine_by_fix_z(*y_bon_, z0)
+
+    min_v = 0.05
+    r = 0.05
+    r = int(round(W * r / 2))
+    force_cuboid = None
+    N = None
+    xs_ = find_N_peaks(y_cor_, r=r, min_v=min_v, N=N)[0]
+    if stats is not None:
+        stats.update(_post_process_stats(y_bon_, y_cor_, xs_, r, z0, z1))
+
+    cor, xy_cor = post_proc.gen_ww(
+        xs_, y_bon_[0], z0, tol=abs(0.16 * z1 / 1.6), force_cuboid=force_cuboid
+    )
+    if not force_cuboid:
+        # Check valid (for fear self-intersection). Corner i is on walls i - 1 and
+        # i, wall i - 1 is written last as in the original loop
+        xy2d = np.zeros((len(xy_cor), 2), np.float32)
+        for i in range(len(xy_cor)):
+            xy2d[i, xy_cor[i]["type"]] = xy_cor[i]["val"]
+            xy2d[i, xy_cor[i - 1]["type"]] = xy_cor[i - 1]["val"]
+        if not post_proc.is_simple_polygon(xy2d):
+            print(
+                "Fail to generate valid general layout!! "
+                "Generate cuboid as fallback.",
+                file=sys.stderr,
+            )
+            xs_ = find_N_peaks(y_cor_, r=r, min_v=0, N=4)[0]
+            cor, xy_cor = post_proc.gen_ww(
+                xs_, y_bon_[0], z0, tol=abs(0.16 * z1 / 1.6), force_cuboid=True
+            )
+            if stats is not None:
+                stats["cuboid_fallback"] = True
+
+    # Expand with btn coory
+    cor = np.hstack([cor, post_proc.infer_coory(cor[:, 1], z1 - z0, z0)[:, None]])
+
+    # Collect corner position in equirectangular
+    cor_id = np.zeros((len(cor) * 2, 2), np.float32)
+    cor_id[0::2] = cor[:, [0, 1]]
+    cor_id[1::2] = cor[:, [0, 2]]
+
+    # Normalized to [0, 1]
+    cor_id[:, 0] /= W
+    cor_id[:, 1] /= H
+    return {
+        "z0": float(z0),
+        "z1": float(z1),
+        "uv": [[float(u), float(v)] for u, v in cor_id],
+    }
+
+
+def _post_process_stats(y_bon_, y_cor_, xs_, r, z0, z1):
+    """Statistics of the post-processing of one image used by layout_confidence."""
+    # Height of each corner peak above the lowest corner probability around it
+    if len(xs_):
+        window = (xs_[:, None] + np.arange(-r, r + 1)) % len(y_cor_)
+        prominence = float((y_cor_[xs_] - y_cor_[window].min(1)).mean())
+    else:
+        prominence = 0.0
+    # Ceiling height of each column, as in post_proc.np_refine_by_fix_z
+    v0 = post_proc.np_coory2v(y_bon_[0])
+    v1 = post_proc.np_coory2v(y_bon_[1])
+    z1s = z0 / np.tan(v0) * np.tan(v1)
+    return {
+        "peak_prominence": prominence,
+        "z1_spread": float(np.std(z1s - z1) / abs(z1)),
+        "cuboid_fallback": False,
+    }
+
+
+class HorizonNetCascade:
+    """Predict layouts with a small model first, and with the large one when unsure
+
+    The layouts of the small model are scored with layout_confidence, the images
+    scoring below the threshold are predicted again by the large model. The
+    number of images and the time spent in each stage are accumulated, see report.
+
+    Parameters
+    ----------
+    small, large : dict, optional
+        Keyword arguments of the HorizonNet of each stage, by default those of
+        DEFAULT_CASCADE. The small model is for example a resnet18 checkpoint, or
+        one without rnn, exported with convert_from_local_ckpt.py as the "small"
+        variant
+    threshold : float
+        Escalate the images whose small model layout scores below it
+    spread_weight : float
+        Weight of the spread of the ceiling heights in layout_confidence
+    """
 
-        # Normalized to [0, 1]
-        cor_id[:, 0] /= W
-        cor_id[:, 1] /= H
+    def __init__(
+        self,
+        small: Optional[dict] = None,
+        large: Optional[dict] = None,
+        threshold: float = DEFAULT_CASCADE["threshold"],
+        spread_weight: float = DEFAULT_CASCADE["spread_weight"],
+    ):
+        self.small = HorizonNet(**(small or DEFAULT_CASCADE["small"]))
+        self.large = HorizonNet(**(large or DEFAULT_CASCADE["large"]))
+        self.threshold = threshold
+        self.spread_weight = spread_weight
+        self.counts = {"small": 0, "large": 0}
+        self.seconds = {"small": 0.0, "large": 0.0}
+
+    def predict(self, image: Union[str, Path, Image.Image, np.ndarray]):
+        """Same as HorizonNet.predict, with the cascade."""
+        return self.predict_batch([image], batch_size=1)[0]
+
+    def predict_batch(
+        self,
+        images: List[Union[str, Path, Image.Image, np.ndarray]],
+        batch_size: Optional[int] = None,
+    ):
+        """Same as HorizonNet.predict_batch, with the cascade."""
+        # Decode the images once for both stages
+        images = [_load_image(image) for image in images]
+
+        start = time.perf_counter()
+        stats = []
+        predictions = self.small.predict_batch(images, batch_size, stats)
+        self.seconds["small"] += time.perf_counter() - start
+        self.counts["small"] += len(images)
+
+        escalated = [
+            i
+            for i, image_stats in enumerate(stats)
+            if layout_confidence(image_stats, self.spread_weight) < self.threshold
+        ]
+        if escalated:
+            start = time.perf_counter()
+            large_predictions = self.large.predict_batch(
+                [images[i] for i in escalated], batch_size
+            )
+            self.seconds["large"] += time.perf_counter() - start
+            self.counts["large"] += len(escalated)
+            for i, prediction in zip(escalated, large_predictions):
+                predictions[i] = prediction
+        return predictions
+
+    def report(self):
+        """Return how often each path is taken and its mean latency per image."""
+        n_images = self.counts["small"]
+        n_large = self.counts["large"]
+        small_ms = self.seconds["small"] * 1000 / max(n_images, 1)
+        large_ms = self.seconds["large"] * 1000 / max(n_large, 1)
         return {
-            "z0": float(z0),
-            "z1": float(z1),
-            "uv": [[float(u), float(v)] for u, v in cor_id],
+            "images": n_images,
+            "small_only_rate": (n_images - n_large) / max(n_images, 1),
+            "escalated_rate": n_large / max(n_images, 1),
+            "latency_small_only_ms": small_ms,
+            "latency_escalated_ms": small_ms + large_ms,
+            "latency_mean_ms": (self.seconds["small"] + self.seconds["large"])
+            * 1000
+            / max(n_images, 1),
         }
 
 
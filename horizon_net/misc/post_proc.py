@@ -4,8 +4,6 @@ https://github.com/sunset1995/HorizonNet/blob/master/misc/post_proc.py
 """
 import numpy as np
 from scipy.ndimage import map_coordinates
-from scipy.spatial.distance import pdist, squareform
-from sklearn.decomposition import PCA
 
 
 PI = float(np.pi)
@@ -85,21 +83,23 @@ def mean_percentile(vec, p1=25, p2=75):
 
 def vote(vec, tol):
     vec = np.sort(vec)
-    n = np.arange(len(vec))[::-1]
-    n = n[:, None] - n[None, :] + 1.0
-    l = squareform(pdist(vec[:, None], "minkowski", p=1) + 1e-9)
-
-    invalid = (n < len(vec) * 0.4) | (l > tol)
-    if (~invalid).sum() == 0 or len(vec) < tol:
+    # Longest run of the sorted values spanning at most tol, with two pointers
+    # instead of the distances of every pair. The distances are computed in
+    # float64 as pdist did, and the first of the longest runs wins as argmax did
+    values = vec.astype(np.float64).tolist()
+    max_row, max_col = 0, -1
+    col = 0
+    for row in range(len(values)):
+        col = max(col, row)
+        while col + 1 < len(values) and values[col + 1] - values[row] + 1e-9 <= tol:
+            col += 1
+        if col - row > max_col - max_row and col - row + 1 >= len(values) * 0.4:
+            max_row, max_col = row, col
+
+    if max_col < max_row or len(vec) < tol:
         best_fit = np.median(vec)
         p_score = 0
     else:
-        l[invalid] = 1e5
-        n[invalid] = -1
-        score = n
-        max_idx = score.argmax()
-        max_row = max_idx // len(vec)
-        max_col = max_idx % len(vec)
         assert max_col > max_row
         best_fit = vec[max_row : max_col + 1].mean()
         p_score = (max_col - max_row + 1) / len(vec)
@@ -175,15 +175,28 @@ def gpid_two_split(xy, tpid_a, tpid_b):
     return va, vb
 
 
+def _principal_directions(xy, gpid, n_groups):
+    """
+    First principal axis (px, py) of the points of each group, from the closed
+    form of the eigenvector of their 2 x 2 covariance, for all the groups at once
+    """
+    count = np.bincount(gpid, minlength=n_groups)
+    mean = np.stack(
+        [np.bincount(gpid, xy[:, i], n_groups) / count for i in range(2)], 1
+    )
+    d = xy - mean[gpid]
+    cxx = np.bincount(gpid, d[:, 0] * d[:, 0], n_groups)
+    cyy = np.bincount(gpid, d[:, 1] * d[:, 1], n_groups)
+    cxy = np.bincount(gpid, d[:, 0] * d[:, 1], n_groups)
+    theta = 0.5 * np.arctan2(2 * cxy, cxx - cyy)
+    return np.cos(theta), np.sin(theta)
+
+
 def _get_rot_rad(px, py):
-    if px < 0:
-        px, py = -px, -py
+    flip = px < 0
+    px, py = np.where(flip, -px, px), np.where(flip, -py, py)
     rad = np.arctan2(py, px) * 180 / np.pi
-    if rad > 45:
-        return 90 - rad
-    if rad < -45:
-        return -90 - rad
-    return -rad
+    return np.where(rad > 45, 90 - rad, np.where(rad < -45, -90 - rad, -rad))
 
 
 def get_rot_rad(
@@ -192,14 +205,11 @@ def get_rot_rad(
     gpid = get_gpid(init_coorx, coorW)
     coor = np.hstack([np.arange(coorW)[:, None], coory[:, None]])
     xy = np_coor2xy(coor, z, coorW, coorH, floorW, floorH)
-    xy_cor = []
 
-    rot_rad_suggestions = []
-    for j in range(len(init_coorx)):
-        pca = PCA(n_components=1)
-        pca.fit(xy[gpid == j])
-        rot_rad_suggestions.append(_get_rot_rad(*pca.components_[0]))
-    rot_rad_suggestions = np.sort(rot_rad_suggestions + [1e9])
+    rot_rad_suggestions = _get_rot_rad(
+        *_principal_directions(xy, gpid, len(init_coorx))
+    )
+    rot_rad_suggestions = np.sort(np.append(rot_rad_suggestions, 1e9))
 
     rot_rad = np.mean(rot_rad_suggestions[:-1])
     best_rot_rad_sz = -1
@@ -413,6 +423,47 @@ def gen_ww_general(init_coorx, xy, gpid, tol):
     return xy_cor
 
 
+def is_simple_polygon(xy):
+    """
+    Whether the closed polygon xy (N x 2) is valid as a floor plan: at least 3
+    distinct corners, and no two walls crossing, touching or overlapping. Same
+    as shapely Polygon(xy).is_valid for a polygon without holes, with all the
+    pairs of walls tested at once
+    """
+    xy = np.asarray(xy, np.float64)
+    # Repeated corners are zero-length walls, which do not make the polygon invalid
+    xy = xy[np.any(xy != np.roll(xy, 1, 0), 1)]
+    n = len(xy)
+    if n < 3:
+        return False
+
+    # Wall i goes from a[i] to b[i]. side_a[i, j] and side_b[i, j] are the sides
+    # of a[j] and b[j] relative to wall i, 0 if they are on its line
+    a, b = xy, np.roll(xy, -1, 0)
+    d = b - a
+    to_a = a[None] - a[:, None]
+    to_b = b[None] - a[:, None]
+    side_a = np.sign(d[:, None, 0] * to_a[..., 1] - d[:, None, 1] * to_a[..., 0])
+    side_b = np.sign(d[:, None, 0] * to_b[..., 1] - d[:, None, 1] * to_b[..., 0])
+    lo = np.minimum(a, b)[:, None]
+    hi = np.maximum(a, b)[:, None]
+    a_in_box = np.all((lo <= a[None]) & (a[None] <= hi), -1)
+    b_in_box = np.all((lo <= b[None]) & (b[None] <= hi), -1)
+    intersect = (side_a * side_b < 0) & (side_a.T * side_b.T < 0)
+    intersect |= (side_a == 0) & a_in_box
+    intersect |= (side_b == 0) & b_in_box
+    intersect |= (side_a.T == 0) & a_in_box.T
+    intersect |= (side_b.T == 0) & b_in_box.T
+
+    # Consecutive walls share a corner, they are only tested for folding back
+    gap = (np.arange(n)[None] - np.arange(n)[:, None]) % n
+    if intersect[(gap > 1) & (gap < n - 1)].any():
+        return False
+    d_next = np.roll(d, -1, 0)
+    turn = d[:, 0] * d_next[:, 1] - d[:, 1] * d_next[:, 0]
+    return not np.any((turn == 0) & (np.sum(d * d_next, 1) < 0))
+
+
 def gen_ww(
     init_coorx,
     coory,
@@ -2,6 +2,9 @@
 Source: assessed on 27/09/2022 from:
 https://github.com/sunset1995/HorizonNet/blob/master/misc/utils.py
 """
+import inspect
+import os
+import platform
 import torch
 import torch.nn as nn
 from collections import OrderedDict
@@ -67,9 +70,35 @@ def save_model(net, path, args):
     torch.save(state_dict, path)
 
 
+def _can_load_on_meta():
+    # torch.device is a context manager since 2.0, load_state_dict has assign and
+    # torch.load has mmap since 2.1
+    return "assign" in inspect.signature(nn.Module.load_state_dict).parameters
+
+
+def _load_checkpoint(path, mmap):
+    # Map the weights of the checkpoint instead of reading them into memory. Only
+    # the zipfile format of torch.save, the default since 1.6, can be mapped, and
+    # torch 2.1 only maps checkpoints given by their filename as a str
+    if mmap:
+        try:
+            return torch.load(str(path), map_location="cpu", mmap=True)
+        except (RuntimeError, ValueError):
+            pass
+    return torch.load(path, map_location="cpu")
+
+
 def load_trained_model(Net, path):
-    state_dict = torch.load(path, map_location="cpu")
-    net = Net(**state_dict["kwargs"])
+    # The checkpoint overwrites every weight: skip the ImageNet weights, and when
+    # possible build on the meta device so that nothing is allocated nor initialized,
+    # the model then uses the mapped weights of the checkpoint as they are
+    on_meta = _can_load_on_meta()
+    state_dict = _load_checkpoint(path, mmap=on_meta)
+    if on_meta:
+        with torch.device("meta"):
+            net = Net(**state_dict["kwargs"], pretrained=False)
+    else:
+        net = Net(**state_dict["kwargs"], pretrained=False)
     state_dict["state_dict"]["x_mean"] = torch.FloatTensor(
         np.array([0.485, 0.456, 0.406])[None, :, None, None]
     )
@@ -77,5 +106,20 @@ def load_trained_model(Net, path):
         np.array([0.229, 0.224, 0.225])[None, :, None, None]
     )
 
-    net.load_state_dict(state_dict["state_dict"], strict=True)
+    if on_meta:
+        net.load_state_dict(state_dict["state_dict"], strict=True, assign=True)
+    else:
+        net.load_state_dict(state_dict["state_dict"], strict=True)
     return net
+
+
+def host_id():
+    # Identify the CPU of the host, to store the benchmarks made on it
+    cpu = platform.processor()
+    if os.path.isfile("/proc/cpuinfo"):
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith("model name"):
+                    cpu = line.split(":", 1)[1].strip()
+                    break
+    return "%s %s x%d" % (platform.machine(), cpu, os.cpu_count() or 1)
@@ -9,6 +9,19 @@ The following changes are made to the original file:
 - replace class variables by register_buffer and add them directly to state_dict later
 - replace del self.encoder.fc, self.encoder.avgpool by assign these layers to nn.Identity()
 - replace zip by enumerate(module)
+- split HorizonNet.forward into the encoder and a decode method, and add forward_rolled
+  to predict horizontally rotated copies of the input with a single encoder pass
+- add export_onnx to run the model with ONNX Runtime
+- add to_channels_last to run the convolutions in channels_last memory format
+- accept B x H x W x C uint8 images, normalized inside the model
+- add convert_lr_pad to replace the LR_PAD wrapped convolutions by LRPadConv2d
+- add fuse_conv_bn to fold the BatchNorm2d layers into the preceding convolutions
+- read the encoder channels from ENCODER_CHANNELS instead of a dummy forward, and
+  add a pretrained argument to skip downloading the ImageNet weights
+- accept 256 x 512 preview images: GlobalHeightConv interpolates its output to the
+  height it has for 512 x 1024 images, and the outputs always have 1024 columns
+- add a channels argument to build a resnet encoder pruned by prune.py, the new
+  channels of its stages are passed to GlobalHeightStage as in_cs
 
 """
 import numpy as np
@@ -18,6 +31,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 import torchvision.models as models
 import functools
+from torch.nn.utils.fusion import fuse_conv_bn_weights
 from typing import List
 
 ENCODER_RESNET = [
@@ -30,6 +44,20 @@ ENCODER_RESNET = [
     "resnext101_32x8d",
 ]
 ENCODER_DENSENET = ["densenet121", "densenet169", "densenet161", "densenet201"]
+# Channels of the 4 feature maps returned by each encoder
+ENCODER_CHANNELS = {
+    "resnet18": (64, 128, 256, 512),
+    "resnet34": (64, 128, 256, 512),
+    "resnet50": (256, 512, 1024, 2048),
+    "resnet101": (256, 512, 1024, 2048),
+    "resnet152": (256, 512, 1024, 2048),
+    "resnext50_32x4d": (256, 512, 1024, 2048),
+    "resnext101_32x8d": (256, 512, 1024, 2048),
+    "densenet121": (256, 512, 1024, 1024),
+    "densenet169": (256, 512, 1280, 1664),
+    "densenet161": (384, 768, 2112, 2208),
+    "densenet201": (256, 512, 1792, 1920),
+}
 
 
 def lr_pad(x, padding: int = 1):
@@ -61,6 +89,82 @@ def wrap_lr_pad(net):
         setattr(root, names[-1], nn.Sequential(LR_PAD(w_pad), m))
 
 
+class LRPadConv2d(nn.Module):
+    """
+    Conv2d with left/right-most padded to each other and zero padding on top/bottom.
+    The convolution zero pads the width natively, then only the few output columns
+    reading that padding are recomputed from narrow wrapped strips of the input,
+    instead of concatenating a full padded copy of the input like LR_PAD.
+    """
+
+    def __init__(self, conv, w_pad: int):
+        super(LRPadConv2d, self).__init__()
+        assert conv.dilation == (1, 1) and conv.padding_mode == "zeros"
+        self.weight = conv.weight
+        if conv.bias is None:
+            self.register_parameter("bias", None)
+        else:
+            self.bias = conv.bias
+        self.stride = conv.stride
+        self.groups = conv.groups
+        self.h_pad = int(conv.padding[0])
+        self.w_pad = w_pad
+        self.kernel_w = conv.kernel_size[1]
+
+    def _conv(self, x, w_pad: int):
+        return F.conv2d(
+            x,
+            self.weight,
+            self.bias,
+            self.stride,
+            [self.h_pad, w_pad],
+            [1, 1],
+            self.groups,
+        )
+
+    def forward(self, x):
+        W = x.shape[3]
+        p, s, k = self.w_pad, self.stride[1], self.kernel_w
+        n_left = (p + s - 1) // s
+        right_start = (W + p - k) // s + 1
+        if right_start <= n_left:
+            # Too narrow to fix the borders separately
+            return self._conv(lr_pad(x, p), 0)
+
+        out = self._conv(x, p)
+        W_out = out.shape[3]
+        left = torch.cat([x[..., W - p :], x[..., : (n_left - 1) * s - p + k]], dim=3)
+        out[..., :n_left] = self._conv(left, 0)
+        if right_start < W_out:
+            n_wrap = max(0, (W_out - 1) * s - p + k - W)
+            right = torch.cat([x[..., right_start * s - p :], x[..., :n_wrap]], dim=3)
+            out[..., right_start:] = self._conv(right, 0)
+        return out
+
+
+def convert_lr_pad(net):
+    """
+    Replace every nn.Sequential(LR_PAD, nn.Conv2d) made by wrap_lr_pad by a
+    LRPadConv2d sharing the same weights. It is meant to be applied on a model
+    loaded with load_trained_model, the outputs are unchanged.
+    """
+    wrapped = []
+    for name, m in net.named_modules():
+        if (
+            isinstance(m, nn.Sequential)
+            and len(m) == 2
+            and isinstance(m[0], LR_PAD)
+            and isinstance(m[1], nn.Conv2d)
+            and m[1].dilation == (1, 1)
+        ):
+            wrapped.append((name, m))
+    for name, m in wrapped:
+        names = name.split(".")
+        root = functools.reduce(lambda o, i: getattr(o, i), [net] + names[:-1])
+        setattr(root, names[-1], LRPadConv2d(m[1], m[0].padding))
+    return net
+
+
 """
 Encoder
 """
@@ -129,6 +233,81 @@ class Densenet(nn.Module):
         return block0, block1, block2, block3, block4
 
 
+def resnet_stage_groups(encoder):
+    """
+    Name the channel group of the output of each stage of a torchvision resnet.
+    The blocks of a stage add their output to the same residual channels, named
+    after the stage, e.g. "layer2", or after the previous stage, or "stem", when
+    the first block has no downsample.
+    """
+    groups = []
+    group = "stem"
+    for n in range(1, 5):
+        if getattr(encoder, "layer%d" % n)[0].downsample is not None:
+            group = "layer%d" % n
+        groups.append(group)
+    return groups
+
+
+def resnet_conv_groups(encoder):
+    """
+    List the convolutions of a torchvision resnet, as tuples (parent, conv name,
+    bn name, input group, output group). Convolutions of the same group share their
+    channels: the stem "stem", the stages of resnet_stage_groups, and the inner
+    channels of a block, named after the convolution, e.g. "layer1.0.conv1".
+    """
+    convs = [(encoder, "conv1", "bn1", "input", "stem")]
+    in_group = "stem"
+    for n, stage_group in enumerate(resnet_stage_groups(encoder), 1):
+        stage = "layer%d" % n
+        for i, block in enumerate(getattr(encoder, stage)):
+            names = [
+                name for name in ["conv1", "conv2", "conv3"] if hasattr(block, name)
+            ]
+            group = in_group
+            for name in names[:-1]:
+                inner_group = "%s.%d.%s" % (stage, i, name)
+                convs.append((block, name, "bn" + name[4:], group, inner_group))
+                group = inner_group
+            convs.append((block, names[-1], "bn" + names[-1][4:], group, stage_group))
+            if block.downsample is not None:
+                convs.append((block.downsample, "0", "1", in_group, stage_group))
+            in_group = stage_group
+    return convs
+
+
+def resize_resnet(encoder, channels):
+    """
+    Replace the convolutions and BatchNorm2d of a torchvision resnet by new ones
+    with the number of channels of each group of resnet_conv_groups given in the
+    channels dictionary, to load the weights of a pruned resnet.
+    Returns the channels of the 4 stages.
+    """
+    for parent, conv_name, bn_name, in_group, out_group in resnet_conv_groups(encoder):
+        conv = getattr(parent, conv_name)
+        in_c = channels.get(in_group, conv.in_channels)
+        out_c = channels.get(out_group, conv.out_channels)
+        if (in_c, out_c) != (conv.in_channels, conv.out_channels):
+            new_conv = nn.Conv2d(
+                in_c,
+                out_c,
+                conv.kernel_size,
+                conv.stride,
+                conv.padding,
+                conv.dilation,
+                conv.groups,
+                conv.bias is not None,
+            )
+            setattr(parent, conv_name, new_conv)
+            setattr(parent, bn_name, nn.BatchNorm2d(out_c))
+    stage_channels = []
+    for n in range(1, 5):
+        block = getattr(encoder, "layer%d" % n)[-1]
+        bn = block.bn3 if hasattr(block, "bn3") else block.bn2
+        stage_channels.append(bn.num_features)
+    return stage_channels
+
+
 """
 Decoder
 """
@@ -151,13 +330,16 @@ class ConvCompressH(nn.Module):
 
 
 class GlobalHeightConv(nn.Module):
-    def __init__(self, in_c, out_c):
+    def __init__(self, in_c, out_c, out_h: int, mid_c=None):
         super(GlobalHeightConv, self).__init__()
+        # mid_c sets the inner channels when the encoder is pruned, default in_c
+        mid_c = mid_c or in_c
+        self.out_h = out_h
         self.layer = nn.Sequential(
-            ConvCompressH(in_c, in_c // 2),
-            ConvCompressH(in_c // 2, in_c // 2),
-            ConvCompressH(in_c // 2, in_c // 4),
-            ConvCompressH(in_c // 4, out_c),
+            ConvCompressH(in_c, mid_c // 2),
+            ConvCompressH(mid_c // 2, mid_c // 2),
+            ConvCompressH(mid_c // 2, mid_c // 4),
+            ConvCompressH(mid_c // 4, out_c),
         )
 
     def forward(self, x, out_w: int):
@@ -166,9 +348,11 @@ class GlobalHeightConv(nn.Module):
         assert out_w % x.shape[3] == 0
         factor = out_w // x.shape[3]
         x = torch.cat([x[..., -1:], x, x[..., :1]], 3)
+        # out_h is the height for 512 x 1024 inputs, where the interpolation
+        # leaves the height unchanged
         x = F.interpolate(
             x,
-            size=[x.shape[2], out_w + 2 * factor],
+            size=[self.out_h, out_w + 2 * factor],
             mode="bilinear",
             align_corners=False,
         )
@@ -177,17 +361,22 @@ class GlobalHeightConv(nn.Module):
 
 
 class GlobalHeightStage(nn.Module):
-    def __init__(self, c1, c2, c3, c4, out_scale=8):
-        """Process 4 blocks from encoder to single multiscale features"""
+    def __init__(self, c1, c2, c3, c4, out_scale=8, in_cs=None):
+        """Process 4 blocks from encoder to single multiscale features
+
+        in_cs are the channels of the 4 blocks if the encoder is pruned, the inner
+        channels are still computed from c1, c2, c3, c4.
+        """
         super(GlobalHeightStage, self).__init__()
         self.cs = c1, c2, c3, c4
         self.out_scale = out_scale
+        in_cs = in_cs or self.cs
         self.ghc_lst = nn.ModuleList(
             [
-                GlobalHeightConv(c1, c1 // out_scale),
-                GlobalHeightConv(c2, c2 // out_scale),
-                GlobalHeightConv(c3, c3 // out_scale),
-                GlobalHeightConv(c4, c4 // out_scale),
+                GlobalHeightConv(in_cs[0], c1 // out_scale, 8, c1),
+                GlobalHeightConv(in_cs[1], c2 // out_scale, 4, c2),
+                GlobalHeightConv(in_cs[2], c3 // out_scale, 2, c3),
+                GlobalHeightConv(in_cs[3], c4 // out_scale, 1, c4),
             ]
         )
 
@@ -221,7 +410,7 @@ class HorizonNet(nn.Module):
     x_std = torch.FloatTensor(np.array([0.229, 0.224, 0.225])[None, :, None, None])
     """
 
-    def __init__(self, backbone, use_rnn):
+    def __init__(self, backbone, use_rnn, pretrained=True, channels=None):
         super(HorizonNet, self).__init__()
         self.register_buffer(
             "x_mean",
@@ -238,23 +427,35 @@ class HorizonNet(nn.Module):
         self.out_scale = 8
         self.step_cols = 4
         self.rnn_hidden_size = 512
+        # Width of the outputs, 256 x 512 preview images are predicted at 1024 columns
+        self.out_cols = 1024
+        self.channels_last = False
+        # forward also accepts B x H x W x C uint8 images
+        self.accepts_uint8 = True
 
         # Encoder
         if backbone.startswith("res"):
-            self.feature_extractor = Resnet(backbone, pretrained=True)
+            self.feature_extractor = Resnet(backbone, pretrained=pretrained)
         elif backbone.startswith("dense"):
-            self.feature_extractor = Densenet(backbone, pretrained=True)
+            self.feature_extractor = Densenet(backbone, pretrained=pretrained)
         else:
             raise NotImplementedError()
 
-        # Inference channels number from each block of the encoder
-        with torch.no_grad():
-            dummy = torch.zeros(1, 3, 512, 1024)
-            c1, c2, c3, c4 = [b.shape[1] for b in self.feature_extractor(dummy)]
-            c_last = (c1 * 8 + c2 * 4 + c3 * 2 + c4 * 1) // self.out_scale
+        # Channels number from each block of the encoder
+        c1, c2, c3, c4 = ENCODER_CHANNELS[backbone]
+        c_last = (c1 * 8 + c2 * 4 + c3 * 2 + c4 * 1) // self.out_scale
+
+        # Channels of a pruned encoder, see resize_resnet
+        in_cs = None
+        if channels:
+            if not backbone.startswith("res"):
+                raise NotImplementedError()
+            in_cs = resize_resnet(self.feature_extractor.encoder, channels)
 
         # Convert features from 4 blocks of the encoder into B x C x 1 x W'
-        self.reduce_height_module = GlobalHeightStage(c1, c2, c3, c4, self.out_scale)
+        self.reduce_height_module = GlobalHeightStage(
+            c1, c2, c3, c4, self.out_scale, in_cs
+        )
 
         # 1D prediction
         if self.use_rnn:
@@ -297,14 +498,63 @@ class HorizonNet(nn.Module):
         # if self.x_mean.device != x.device:
         #    self.x_mean = self.x_mean.to(x.device)
         #    self.x_std = self.x_std.to(x.device)
-        return (x[:, :3] - self.x_mean) / self.x_std
+        if x.dtype == torch.uint8:
+            # B x H x W x C view of uint8 images, scaling and normalization fused
+            x = x[..., :3].permute(0, 3, 1, 2).float()
+            x = x * (1.0 / 255.0 / self.x_std) - self.x_mean / self.x_std
+        else:
+            x = (x[:, :3] - self.x_mean) / self.x_std
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+        return x
 
     def forward(self, x):
-        if x.shape[2] != 512 or x.shape[3] != 1024:
+        x = self._prepare_x(x)
+        full = x.shape[2] == 512 and x.shape[3] == 1024
+        preview = x.shape[2] == 256 and x.shape[3] == 512
+        if not (full or preview):
             raise NotImplementedError()
+        conv_list = self.feature_extractor(x)
+        return self.decode(conv_list, self.out_cols)
+
+    @torch.jit.export
+    def forward_rolled(self, x, shifts: List[int]):
+        """
+        Predict the rotated copies of x for each horizontal shift (in pixels).
+        The encoder runs once, the rotations are obtained by rolling its
+        feature maps, and the outputs are rolled back to the original image.
+        Shifts must be multiples of 32 pixels, the stride of the last block.
+        Returns bon, cor of shape len(shifts)*B x C x W, grouped by shift.
+        """
         x = self._prepare_x(x)
+        if x.shape[2] != 512 or x.shape[3] != 1024:
+            raise NotImplementedError()
         conv_list = self.feature_extractor(x)
-        feature = self.reduce_height_module(conv_list, x.shape[3] // self.step_cols)
+        W = x.shape[3]
+
+        rolled_list: List[torch.Tensor] = []
+        for f in conv_list:
+            rolled: List[torch.Tensor] = []
+            for shift in shifts:
+                if (shift * f.shape[3]) % W != 0:
+                    raise ValueError("Shifts must be multiples of the encoder stride")
+                rolled.append(torch.roll(f, shift * f.shape[3] // W, dims=[3]))
+            rolled_list.append(torch.cat(rolled, 0))
+        bon, cor = self.decode(rolled_list, W)
+
+        # Roll the outputs back
+        bs = x.shape[0]
+        bon_lst: List[torch.Tensor] = []
+        cor_lst: List[torch.Tensor] = []
+        for i, shift in enumerate(shifts):
+            out_shift = -(shift * bon.shape[2] // W)
+            bon_lst.append(torch.roll(bon[i * bs : (i + 1) * bs], out_shift, dims=[2]))
+            cor_lst.append(torch.roll(cor[i * bs : (i + 1) * bs], out_shift, dims=[2]))
+        return torch.cat(bon_lst, 0), torch.cat(cor_lst, 0)
+
+    def decode(self, conv_list: List[torch.Tensor], out_cols: int):
+        """Predict out_cols columns of bon, cor from the 4 encoder feature maps."""
+        feature = self.reduce_height_module(conv_list, out_cols // self.step_cols)
 
         # rnn
         if self.use_rnn:
@@ -337,3 +587,91 @@ class HorizonNet(nn.Module):
         bon = output[:, 1:]  # B x 2 x W
 
         return bon, cor
+
+
+def export_onnx(net, path, opset_version=13):
+    """
+    Export HorizonNet to ONNX, with a dynamic batch dimension.
+    The lr_pad concatenations are exported as Slice/Concat and the bi-LSTM as a
+    native ONNX LSTM. Only forward is exported, forward_rolled is TorchScript only.
+    The exported model takes B x 512 x 1024 x 3 uint8 images.
+    """
+    net.eval()
+    dummy = torch.zeros(1, 512, 1024, 3, dtype=torch.uint8)
+    with torch.no_grad():
+        torch.onnx.export(
+            net,
+            dummy,
+            str(path),
+            input_names=["x"],
+            output_names=["bon", "cor"],
+            dynamic_axes={"x": {0: "batch"}, "bon": {0: "batch"}, "cor": {0: "batch"}},
+            opset_version=opset_version,
+        )
+
+
+def to_channels_last(net):
+    """
+    Convert the conv weights of HorizonNet to channels_last, and make it convert
+    its input too, so that oneDNN runs the convolutions in NHWC layout.
+    The lr_pad concatenations, interpolations and reshapes accept any layout.
+    """
+    net.channels_last = True
+    return net.to(memory_format=torch.channels_last)
+
+
+def unwrap_conv(m):
+    """Return the convolution holding the weights of m, or None if m is not one."""
+    if isinstance(m, (nn.Conv2d, LRPadConv2d)):
+        return m
+    if (
+        isinstance(m, nn.Sequential)
+        and len(m) == 2
+        and isinstance(m[0], LR_PAD)
+        and isinstance(m[1], nn.Conv2d)
+    ):
+        return m[1]
+    return None
+
+
+def _fuse_pair(conv, bn):
+    conv.weight, conv.bias = fuse_conv_bn_weights(
+        conv.weight,
+        conv.bias,
+        bn.running_mean,
+        bn.running_var,
+        bn.eps,
+        bn.weight,
+        bn.bias,
+    )
+
+
+def fuse_conv_bn(net):
+    """
+    Fold every BatchNorm2d following a convolution into the convolution weights,
+    and replace the BatchNorm2d by nn.Identity. The convolutions may be wrapped by
+    wrap_lr_pad or converted by convert_lr_pad. Two patterns are fused:
+    consecutive modules of a plain nn.Sequential, e.g. ConvCompressH and the
+    downsample of the resnet blocks, and sibling convN / bnN attributes of the
+    torchvision resnet and its blocks. The model must be in eval mode.
+    """
+    assert not net.training, "BatchNorm can only be fused in eval mode"
+    for parent in list(net.modules()):
+        children = dict(parent.named_children())
+        names = list(children)
+        pairs = []
+        if type(parent) is nn.Sequential:
+            pairs += list(zip(names[:-1], names[1:]))
+        pairs += [
+            ("conv" + name[2:], name)
+            for name in names
+            if name.startswith("bn") and "conv" + name[2:] in children
+        ]
+        for conv_name, bn_name in pairs:
+            conv = unwrap_conv(children[conv_name])
+            bn = children[bn_name]
+            if conv is not None and type(bn) is nn.BatchNorm2d:
+                _fuse_pair(conv, bn)
+                setattr(parent, bn_name, nn.Identity())
+                children[bn_name] = getattr(parent, bn_name)
+    return net
@@ -0,0 +1,174 @@
+"""
+Compare the layouts predicted by two HorizonNet configurations.
+
+The reference configuration plays the role of the ground truth in
+eval_general.test_general, which gives the 2D/3D IoU, the depth RMSE and
+delta^1 of the candidate layouts. The difference of the corner positions and
+ceiling heights, and the latency of both configurations, are also reported.
+
+Example usage as a script, from the root of the repository:
+
+  python -m horizon_net.parity --candidate '{"tta": {"mode": "feature", "flip": false}}' --reference '{"tta": {"mode": "input", "flip": false}}'
+
+It will report the accuracy of rotation tta computed from rolled feature maps
+against rotation tta computed by re-encoding every rotated image.
+
+  python -m horizon_net.parity --candidate '{"variant": "int8"}'
+
+It will report the accuracy and latency of the int8 model against the float32 one.
+
+  python -m horizon_net.parity --candidate '{"precision": "bfloat16"}' --min_3diou 0.98 --max_uv_diff 0.005 --max_z1_diff 0.5
+
+It will exit with an error if the bfloat16 layouts of the bundled panoramas
+are not within the given tolerances of the float32 ones.
+
+  python -m horizon_net.parity --candidate '{"preview": true}'
+
+It will report the accuracy and latency of the 256 x 512 preview mode against
+the full resolution model.
+"""
+import argparse
+from collections import defaultdict
+import glob
+import json
+import sys
+import time
+
+import numpy as np
+
+from .eval_general import test_general
+from .horizonnet_reconstruction import HorizonNet, IMAGE_DIRNAME
+
+DEFAULT_IMAGE_GLOB = str(IMAGE_DIRNAME / "assets" / "preprocessed" / "*_rgb.png")
+METRICS = ["2DIoU", "3DIoU", "rmse", "delta_1"]
+
+
+def layout_metrics(dt, gt, w=1024, h=512):
+    """Compare the prediction dictionary dt against the prediction dictionary gt."""
+    dt_cor_id = np.array(dt["uv"], np.float32) * [w, h]
+    gt_cor_id = np.array(gt["uv"], np.float32) * [w, h]
+    losses = defaultdict(lambda: {metric: [] for metric in METRICS})
+    test_general(dt_cor_id, gt_cor_id, w, h, losses)
+
+    metrics = {
+        metric: float(values[0]) if values else float("nan")
+        for metric, values in losses["overall"].items()
+    }
+    metrics["z1_abs_diff"] = abs(dt["z1"] - gt["z1"])
+    if dt_cor_id.shape == gt_cor_id.shape:
+        metrics["uv_max_abs_diff"] = float(
+            np.abs(np.array(dt["uv"]) - np.array(gt["uv"])).max()
+        )
+    else:
+        metrics["uv_max_abs_diff"] = float("inf")
+    return metrics
+
+
+def compare(reference, candidate, images):
+    """Predict images with both models and return the mean metrics and latencies."""
+    per_image = []
+    latency = {"reference": 0.0, "candidate": 0.0}
+    for image in images:
+        start = time.perf_counter()
+        gt = reference.predict(image)
+        latency["reference"] += time.perf_counter() - start
+        start = time.perf_counter()
+        dt = candidate.predict(image)
+        latency["candidate"] += time.perf_counter() - start
+        per_image.append(layout_metrics(dt, gt))
+
+    summary = {
+        key: float(np.mean([metrics[key] for metrics in per_image]))
+        for key in per_image[0]
+    }
+    summary["uv_max_abs_diff"] = max(m["uv_max_abs_diff"] for m in per_image)
+    summary.update(
+        {"latency_%s_ms" % k: v * 1000 / len(images) for k, v in latency.items()}
+    )
+    return summary
+
+
+def print_report(summary):
+    """Print the output of compare."""
+    for key, value in summary.items():
+        print("    %-22s: %.4f" % (key, value))
+
+
+def check(summary, min_3diou=None, max_uv_diff=None, max_z1_diff=None):
+    """Return the list of tolerances the output of compare does not meet."""
+    failures = []
+    if min_3diou is not None and not summary["3DIoU"] >= min_3diou:
+        failures.append("3DIoU %.4f < %.4f" % (summary["3DIoU"], min_3diou))
+    if max_uv_diff is not None and not summary["uv_max_abs_diff"] <= max_uv_diff:
+        failures.append(
+            "uv difference %.4f > %.4f" % (summary["uv_max_abs_diff"], max_uv_diff)
+        )
+    if max_z1_diff is not None and not summary["z1_abs_diff"] <= max_z1_diff:
+        failures.append(
+            "z1 difference %.4f > %.4f" % (summary["z1_abs_diff"], max_z1_diff)
+        )
+    return failures
+
+
+def _setup_parser():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument(
+        "--reference",
+        type=json.loads,
+        default={},
+        help="JSON keyword arguments of the reference HorizonNet.",
+    )
+    parser.add_argument(
+        "--candidate",
+        type=json.loads,
+        default={},
+        help="JSON keyword arguments of the candidate HorizonNet.",
+    )
+    parser.add_argument(
+        "--image_glob",
+        type=str,
+        default=DEFAULT_IMAGE_GLOB,
+        help="Aligned panoramas to compare the predictions on.",
+    )
+    parser.add_argument(
+        "--min_3diou",
+        type=float,
+        default=None,
+        help="Fail if the mean 3D IoU with the reference is lower.",
+    )
+    parser.add_argument(
+        "--max_uv_diff",
+        type=float,
+        default=None,
+        help="Fail if a corner moves more than this, in normalized uv coordinates.",
+    )
+    parser.add_argument(
+        "--max_z1_diff",
+        type=float,
+        default=None,
+        help="Fail if the mean absolute difference of z1 is larger.",
+    )
+    return parser
+
+
+def main(args):
+    """Compare the candidate and reference models on the images."""
+    images = sorted(glob.glob(args.image_glob))
+    if not images:
+        raise FileNotFoundError("No image matches %s" % args.image_glob)
+    summary = compare(
+        HorizonNet(**args.reference), HorizonNet(**args.candidate), images
+    )
+    print("Candidate %s vs reference %s" % (args.candidate, args.reference))
+    print_report(summary)
+    failures = check(summary, args.min_3diou, args.max_uv_diff, args.max_z1_diff)
+    if failures:
+        print("Parity check failed: %s" % "; ".join(failures))
+        sys.exit(1)
+    return summary
+
+
+if __name__ == "__main__":
+    parser = _setup_parser()
+    args = parser.parse_args()
+    main(args)
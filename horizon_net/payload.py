@@ -0,0 +1,195 @@
+"""
+Encode prediction dictionaries in a compact versioned binary payload.
+
+The payload is a little-endian header followed by float32 arrays:
+
+  magic        4 bytes  b"HZNL"
+  version      uint8    FORMAT_VERSION
+  flags        uint8    FLAG_RAW if the raw outputs follow the corners
+  n_corners    uint16   number of rows of uv
+  width        uint16   number of columns of the raw outputs, 0 without them
+  z0, z1       float32  floor and ceiling heights
+  uv           float32  n_corners x 2 normalized corner positions
+  y_bon        float32  2 x width floor and ceiling boundaries, with FLAG_RAW
+  y_cor        float32  width corner probabilities, with FLAG_RAW
+
+The model handler returns it instead of JSON when a request asks for it, see
+model/app.py, and the frontend decodes it with decode_prediction.
+
+The round trip of the payloads and their size against JSON can be checked,
+from the root of the repository, with:
+
+  python -m horizon_net.payload --prediction_file horizon_net/assets/inferenced/demo_aligned_rgb.json
+"""
+import argparse
+import base64
+import json
+from pathlib import Path
+import struct
+import sys
+
+import numpy as np
+
+MIME_TYPE = "application/vnd.horizonnet.layout"
+MAGIC = b"HZNL"
+FORMAT_VERSION = 1
+FLAG_RAW = 1
+# z1 is computed in float32 from the model outputs, so it round-trips exactly
+HEADER = struct.Struct("<4sBBHHff")
+
+
+def encode_prediction(prediction, raw=False):
+    """Return the binary payload of a prediction dictionary.
+
+    Parameters
+    ----------
+    prediction : dict
+        Output of HorizonNet.predict, with y_bon and y_cor if raw is True
+    raw : bool
+        Include the raw y_bon and y_cor outputs of the model
+    """
+    uv = np.asarray(prediction["uv"], "<f4").reshape(-1, 2)
+    arrays = [uv]
+    width = 0
+    if raw:
+        y_bon = np.asarray(prediction["y_bon"], "<f4")
+        y_cor = np.asarray(prediction["y_cor"], "<f4")
+        width = y_cor.shape[-1]
+        if y_bon.shape != (2, width) or y_cor.shape != (width,):
+            raise ValueError(
+                "Expected y_bon of shape (2, W) and y_cor of shape (W,), got %s and %s"
+                % (y_bon.shape, y_cor.shape)
+            )
+        arrays += [y_bon, y_cor]
+    header = HEADER.pack(
+        MAGIC,
+        FORMAT_VERSION,
+        FLAG_RAW if raw else 0,
+        len(uv),
+        width,
+        prediction["z0"],
+        prediction["z1"],
+    )
+    return b"".join([header] + [array.tobytes() for array in arrays])
+
+
+def decode_prediction(data):
+    """Return the prediction dictionary of a binary payload.
+
+    uv, y_bon and y_cor are float32 numpy arrays. A base64 string, as sent by
+    transports which cannot carry binary, is decoded first.
+    """
+    if isinstance(data, str):
+        data = base64.b64decode(data)
+    if len(data) < HEADER.size:
+        raise ValueError("Payload of %d bytes is shorter than its header" % len(data))
+    magic, version, flags, n_corners, width, z0, z1 = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError("Not a HorizonNet payload")
+    if version != FORMAT_VERSION:
+        raise ValueError(
+            "Unsupported payload version %d, expected %d" % (version, FORMAT_VERSION)
+        )
+    n_values = n_corners * 2 + (3 * width if flags & FLAG_RAW else 0)
+    if len(data) != HEADER.size + n_values * 4:
+        raise ValueError("Payload of %d bytes is truncated" % len(data))
+
+    values = np.frombuffer(data, "<f4", n_values, HEADER.size)
+    prediction = {"z0": z0, "z1": z1, "uv": values[: n_corners * 2].reshape(-1, 2)}
+    if flags & FLAG_RAW:
+        raw = values[n_corners * 2 :]
+        prediction["y_bon"] = raw[: 2 * width].reshape(2, width)
+        prediction["y_cor"] = raw[2 * width :]
+    return prediction
+
+
+def to_json(prediction):
+    """Return a prediction dictionary with the numpy arrays converted to lists."""
+    return {
+        key: value.tolist() if isinstance(value, np.ndarray) else value
+        for key, value in prediction.items()
+    }
+
+
+def random_prediction(rng, n_corners=None, width=1024):
+    """Return a random prediction dictionary with raw outputs, as predict(raw=True)."""
+    n_corners = 2 * int(rng.integers(2, 17)) if n_corners is None else n_corners
+    return {
+        "z0": 50.0,
+        "z1": float(np.float32(rng.uniform(-80, -30))),
+        "uv": rng.random((n_corners, 2)).astype(np.float32).tolist(),
+        "y_bon": rng.uniform(-np.pi / 2, np.pi / 2, (2, width)).astype(np.float32),
+        "y_cor": rng.random(width).astype(np.float32),
+    }
+
+
+def check_round_trip(prediction, raw):
+    """Whether decoding the payload of prediction gives it back."""
+    decoded = decode_prediction(encode_prediction(prediction, raw))
+    keys = ["z0", "z1", "uv"] + (["y_bon", "y_cor"] if raw else [])
+    if sorted(decoded) != sorted(keys):
+        return False
+    for key in keys:
+        if key in ["z0", "z1"]:
+            if decoded[key] != prediction[key]:
+                return False
+        elif not np.array_equal(decoded[key], np.asarray(prediction[key], "<f4")):
+            return False
+    return True
+
+
+def _setup_parser():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument(
+        "--prediction_file",
+        type=str,
+        default=str(
+            Path(__file__).resolve().parent
+            / "assets"
+            / "inferenced"
+            / "demo_aligned_rgb.json"
+        ),
+        help="JSON prediction to compare the payload sizes on.",
+    )
+    parser.add_argument(
+        "--n_cases", type=int, default=1000, help="Number of random round trips."
+    )
+    parser.add_argument(
+        "--seed", type=int, default=0, help="Seed of the random predictions."
+    )
+    return parser
+
+
+def main(args):
+    """Check the round trip of random payloads and compare the sizes with JSON."""
+    rng = np.random.default_rng(args.seed)
+    n_failed = sum(
+        not check_round_trip(random_prediction(rng), raw)
+        for _ in range(args.n_cases)
+        for raw in [False, True]
+    )
+    print("round trip: %d / %d payloads differ" % (n_failed, 2 * args.n_cases))
+
+    with open(args.prediction_file) as f:
+        prediction = json.load(f)
+    # Random raw outputs of the same shape as the model ones
+    raw_outputs = random_prediction(rng)
+    prediction["y_bon"] = raw_outputs["y_bon"]
+    prediction["y_cor"] = raw_outputs["y_cor"]
+    print("%d corners, payload sizes in bytes:" % len(prediction["uv"]))
+    for raw in [False, True]:
+        keys = ["z0", "z1", "uv"] + (["y_bon", "y_cor"] if raw else [])
+        json_size = len(json.dumps(to_json({key: prediction[key] for key in keys})))
+        binary_size = len(encode_prediction(prediction, raw))
+        print(
+            "    raw=%-5s: json %7d, binary %7d, binary base64 %7d"
+            % (raw, json_size, binary_size, 4 * ((binary_size + 2) // 3))
+        )
+    if n_failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = _setup_parser()
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,244 @@
+"""
+Prune the channels of the resnet encoder of a HorizonNet checkpoint.
+
+The channels of each group of model.resnet_conv_groups are ranked by the
+magnitude of the BatchNorm2d weights following them, summed over the
+convolutions of the group, and the least important ones are removed. The
+inner channels of the blocks and the residual channels of the stages listed by
+Resnet.list_blocks are pruned, the stem is kept. GlobalHeightStage takes the
+pruned stage channels as input, its own channels and the rnn are unchanged.
+
+Every keep ratio is tried from the smallest model, and the first one whose 3D
+IoU, computed with eval_general.test_general on a labelled test set, is within
+--max_3diou_drop of the unpruned checkpoint is saved.
+
+Example usage as a script, from the root of the repository:
+
+  python -m horizon_net.prune --ckpt_name resnet50_rnn__zind.pth --img_glob 'data/test/img/*.png' --gt_glob 'data/test/label_cor/*.txt' --max_3diou_drop 0.02
+
+It will save the pruned checkpoint to horizon_net/ckpt/resnet50_rnn__zind_pruned.pth,
+which is exported like any other checkpoint:
+
+  cd horizon_net
+  python convert_from_local_ckpt.py --ckpt_name resnet50_rnn__zind_pruned.pth --staged_model_name horizonNet_pruned.pt
+"""
+import argparse
+from collections import defaultdict
+import glob
+import os
+from pathlib import Path
+import sys
+import tempfile
+
+import numpy as np
+import torch
+
+from .eval_general import test_general
+from .horizonnet_reconstruction import HorizonNet
+from .misc.utils import load_trained_model
+from .model import (
+    HorizonNet as Net,
+    resnet_conv_groups,
+    resnet_stage_groups,
+    unwrap_conv,
+)
+from .parity import METRICS
+
+CHECKPOINT_DIRNAME = Path(__file__).resolve().parent / "ckpt"
+# Pruned channels are rounded to a multiple of it, to keep the convolutions
+# vectorized on CPU
+CHANNEL_MULTIPLE = 8
+
+
+def channel_importance(net):
+    """Return the importance of the channels of each prunable group of the encoder."""
+    encoder = net.feature_extractor.encoder
+    importance = defaultdict(float)
+    for parent, _, bn_name, _, out_group in resnet_conv_groups(encoder):
+        if out_group != "stem":
+            importance[out_group] += getattr(parent, bn_name).weight.detach().abs()
+    return importance
+
+
+def prune_channels(net, keep_ratio):
+    """Return the channels and the indices of the channels kept in each group."""
+    channels = {}
+    keep = {}
+    for group, importance in channel_importance(net).items():
+        n_channels = len(importance)
+        n_keep = int(round(n_channels * keep_ratio / CHANNEL_MULTIPLE))
+        n_keep = min(max(n_keep * CHANNEL_MULTIPLE, CHANNEL_MULTIPLE), n_channels)
+        keep[group] = torch.argsort(importance, descending=True)[:n_keep].sort()[0]
+        channels[group] = n_keep
+    return channels, keep
+
+
+def build_pruned_model(net, channels, keep):
+    """Build the pruned HorizonNet and copy the kept weights of net into it."""
+    pruned = Net(net.backbone, net.use_rnn, pretrained=False, channels=channels)
+    pruned.eval()
+    state_dict = pruned.state_dict()
+    pruned.load_state_dict(
+        {
+            key: value
+            for key, value in net.state_dict().items()
+            if value.shape == state_dict[key].shape
+        },
+        strict=False,
+    )
+
+    def index(group):
+        return keep.get(group, slice(None))
+
+    with torch.no_grad():
+        for src, dst in zip(
+            resnet_conv_groups(net.feature_extractor.encoder),
+            resnet_conv_groups(pruned.feature_extractor.encoder),
+        ):
+            parent, conv_name, bn_name, in_group, out_group = src
+            weight = unwrap_conv(getattr(parent, conv_name)).weight
+            unwrap_conv(getattr(dst[0], conv_name)).weight.copy_(
+                weight[index(out_group)][:, index(in_group)]
+            )
+            bn = getattr(parent, bn_name)
+            for name in ["weight", "bias", "running_mean", "running_var"]:
+                getattr(getattr(dst[0], bn_name), name).copy_(
+                    getattr(bn, name)[index(out_group)]
+                )
+        # The first convolution of each GlobalHeightConv reads the pruned stages
+        stage_groups = resnet_stage_groups(net.feature_extractor.encoder)
+        for group, src, dst in zip(
+            stage_groups,
+            net.reduce_height_module.ghc_lst,
+            pruned.reduce_height_module.ghc_lst,
+        ):
+            weight = unwrap_conv(src.layer[0].layers[0]).weight
+            unwrap_conv(dst.layer[0].layers[0]).weight.copy_(weight[:, index(group)])
+    return pruned
+
+
+def evaluate(net, pairs):
+    """Return the mean metrics of eval_general.test_general of net on the pairs."""
+    with tempfile.TemporaryDirectory() as directory:
+        model_file = os.path.join(directory, "model.pt")
+        torch.jit.script(net).save(model_file)
+        model = HorizonNet(model_file=model_file)
+        losses = defaultdict(lambda: {metric: [] for metric in METRICS})
+        for img_path, gt_path in pairs:
+            with open(gt_path) as f:
+                gt_cor_id = np.array([line.split() for line in f], np.float32)
+            dt_cor_id = np.array(model.predict(img_path)["uv"], np.float32)
+            test_general(dt_cor_id * [1024, 512], gt_cor_id, 1024, 512, losses)
+    return {metric: float(np.mean(v)) for metric, v in losses["overall"].items()}
+
+
+def n_parameters(net):
+    """Number of parameters of the encoder and of the whole model."""
+    encoder = sum(p.numel() for p in net.feature_extractor.parameters())
+    return encoder, sum(p.numel() for p in net.parameters())
+
+
+def prepare_img_gt_pairs(img_glob, gt_glob):
+    """Pair the images and the ground truth files with the same name."""
+    gt_paths = {Path(path).stem: path for path in glob.glob(gt_glob)}
+    return [
+        (path, gt_paths[Path(path).stem])
+        for path in sorted(glob.glob(img_glob))
+        if Path(path).stem in gt_paths
+    ]
+
+
+def search(net, pairs, keep_ratios, max_3diou_drop):
+    """Return the smallest pruned model within max_3diou_drop of net, or None."""
+    baseline = evaluate(net, pairs)
+    print("unpruned : %d encoder params, %s" % (n_parameters(net)[0], baseline))
+    for keep_ratio in sorted(keep_ratios):
+        channels, keep = prune_channels(net, keep_ratio)
+        pruned = build_pruned_model(net, channels, keep)
+        metrics = evaluate(pruned, pairs)
+        print(
+            "keep %.3f: %d encoder params, %s"
+            % (keep_ratio, n_parameters(pruned)[0], metrics)
+        )
+        if baseline["3DIoU"] - metrics["3DIoU"] <= max_3diou_drop:
+            return pruned, channels
+    return None, None
+
+
+def save_pruned_model(pruned, channels, path):
+    """Save the pruned model as a checkpoint readable by load_trained_model."""
+    torch.save(
+        {
+            "kwargs": {
+                "backbone": pruned.backbone,
+                "use_rnn": pruned.use_rnn,
+                "channels": channels,
+            },
+            "state_dict": pruned.state_dict(),
+        },
+        path,
+    )
+
+
+def _setup_parser():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument(
+        "--ckpt_name",
+        type=str,
+        default="resnet50_rnn__zind.pth",
+        help="Name of the checkpoint to prune, in horizon_net/ckpt.",
+    )
+    parser.add_argument(
+        "--img_glob", type=str, required=True, help="Aligned test panoramas."
+    )
+    parser.add_argument(
+        "--gt_glob",
+        type=str,
+        required=True,
+        help="Ground truth corners of the test panoramas, txt files with the same names.",
+    )
+    parser.add_argument(
+        "--max_3diou_drop",
+        type=float,
+        default=0.02,
+        help="Largest drop of the mean 3D IoU allowed, between 0 and 1.",
+    )
+    parser.add_argument(
+        "--keep_ratios",
+        type=float,
+        nargs="+",
+        default=[0.25, 0.375, 0.5, 0.625, 0.75, 0.875],
+        help="Fractions of the channels of each group to try keeping.",
+    )
+    parser.add_argument(
+        "--output_name",
+        type=str,
+        default=None,
+        help="Name of the pruned checkpoint in horizon_net/ckpt. Default is the checkpoint name with a _pruned suffix.",
+    )
+    return parser
+
+
+def main(args):
+    """Search and save the smallest pruned model within the 3D IoU budget."""
+    pairs = prepare_img_gt_pairs(args.img_glob, args.gt_glob)
+    if not pairs:
+        raise FileNotFoundError("No image of %s has a ground truth" % args.img_glob)
+    net = load_trained_model(Net, CHECKPOINT_DIRNAME / args.ckpt_name).eval()
+    if not net.backbone.startswith("resnet"):
+        # The grouped convolutions of resnext would need the groups pruned together
+        raise ValueError("Only the resnet encoders can be pruned")
+
+    pruned, channels = search(net, pairs, args.keep_ratios, args.max_3diou_drop)
+    if pruned is None:
+        print("No pruned model is within a 3D IoU drop of %s" % args.max_3diou_drop)
+        sys.exit(1)
+    output_name = args.output_name or "%s_pruned.pth" % Path(args.ckpt_name).stem
+    save_pruned_model(pruned, channels, CHECKPOINT_DIRNAME / output_name)
+    print("Pruned checkpoint saved to %s" % (CHECKPOINT_DIRNAME / output_name))
+
+
+if __name__ == "__main__":
+    parser = _setup_parser()
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,107 @@
+"""
+Serve several named HorizonNet models from one process.
+
+Each name is a torchscript model exported from one checkpoint, for example:
+
+  cd horizon_net
+  python convert_from_local_ckpt.py --ckpt_name resnet50_rnn__st3d.pth --staged_model_name horizonNet_st3d.pt
+
+Models are downloaded and loaded on their first request, or downloaded ahead
+in a background thread with prefetch. When loading a model would exceed the
+memory budget, the least recently used models are evicted.
+
+Only the models published with a checksum are in MODEL_NAMES, the others can
+be served once their artifact and its .sha256 file are in MODEL_BUCKET_URL.
+
+Example usage from python:
+
+  registry = ModelRegistry(dict(MODEL_NAMES, st3d="horizonNet_st3d.pt"))
+  prediction = registry.get("st3d").predict(image)
+"""
+from collections import OrderedDict
+import gc
+import os
+import threading
+from typing import Optional
+
+from .horizonnet_reconstruction import (
+    download_model_file,
+    HorizonNet,
+    prefetch_model_file,
+)
+
+# Torchscript artifact of each named model published in MODEL_BUCKET_URL
+MODEL_NAMES = {
+    "zind": "horizonNet.pt",
+}
+DEFAULT_MODEL_NAME = "zind"
+# Memory budget of the loaded models, estimated from the size of their artifacts
+MAX_MODEL_MEMORY_MB = float(os.environ.get("HORIZONNET_MAX_MODEL_MEMORY_MB", 1024))
+
+
+class ModelRegistry:
+    """Named HorizonNet models loaded lazily, with LRU eviction.
+
+    Parameters
+    ----------
+    models : dict, optional
+        Artifact filename of each model name, MODEL_NAMES by default
+    max_memory_mb : float
+        Memory budget of the loaded models. The model being loaded is always
+        kept, even if it is larger than the budget on its own
+    model_kwargs
+        Keyword arguments of HorizonNet shared by every model, e.g. config
+    """
+
+    def __init__(
+        self,
+        models: Optional[dict] = None,
+        max_memory_mb: float = MAX_MODEL_MEMORY_MB,
+        **model_kwargs,
+    ):
+        self.models = models or MODEL_NAMES
+        self.max_memory_mb = max_memory_mb
+        self.model_kwargs = model_kwargs
+        # name -> (HorizonNet, size in MB), least recently used first
+        self.loaded = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, name: str = DEFAULT_MODEL_NAME):
+        """Return the model of this name, loading it if needed."""
+        self._check_name(name)
+        with self.lock:
+            if name in self.loaded:
+                self.loaded.move_to_end(name)
+                return self.loaded[name][0]
+
+            model_file = download_model_file(self.models[name])
+            size_mb = os.path.getsize(model_file) / 2**20
+            self._evict(self.max_memory_mb - size_mb)
+            model = HorizonNet(model_file=model_file, **self.model_kwargs)
+            self.loaded[name] = (model, size_mb)
+            return model
+
+    def prefetch(self, name: str = DEFAULT_MODEL_NAME):
+        """Download the model of this name in a background thread, without loading it."""
+        self._check_name(name)
+        return prefetch_model_file(self.models[name])
+
+    def memory_mb(self):
+        """Estimated memory of the loaded models."""
+        return sum(size_mb for _, size_mb in self.loaded.values())
+
+    def _check_name(self, name):
+        if name not in self.models:
+            raise ValueError(
+                "Unknown model %s, expected one of %s" % (name, ", ".join(self.models))
+            )
+
+    def _evict(self, max_memory_mb):
+        """Unload the least recently used models until they fit in max_memory_mb."""
+        evicted = False
+        while self.loaded and self.memory_mb() > max_memory_mb:
+            name, _ = self.loaded.popitem(last=False)
+            print("INFO evicting model %s" % name)
+            evicted = True
+        if evicted:
+            gc.collect()
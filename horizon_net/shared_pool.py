@@ -0,0 +1,146 @@
+"""
+Serve HorizonNet from forked worker processes sharing one copy of the weights.
+
+The parent process loads the torchscript model once and moves its parameters
+and buffers to shared memory, then forks the workers, which read the same
+memory pages instead of loading their own copy with torch.jit.load. The memory
+of the host stays roughly flat as workers are added.
+
+Example usage from python:
+
+  with SharedModelPool(n_workers=4) as pool:
+      predictions = pool.predict_batch(images)
+
+The parent must not run the model before the workers are forked: the OpenMP
+thread pool of torch is not fork-safe, so the workers warm up on their own.
+Fork is only available on Linux and macOS.
+
+The memory of the host can be measured, from the root of the repository, with:
+
+  python -m horizon_net.benchmark workers horizon_net/assets/preprocessed/demo_aligned_rgb.png --workers 1 4 8
+
+It will compare the memory of the host with workers loading their own model
+and with workers sharing the weights of the parent.
+"""
+import itertools
+import multiprocessing as mp
+
+import torch
+
+from .horizonnet_reconstruction import HorizonNet, TorchScriptBackend
+
+# Model of the parent process, inherited by the forked workers
+_MODEL = None
+
+
+def share_weights(model):
+    """Move the parameters and buffers of a torchscript HorizonNet to shared memory."""
+    if not isinstance(model.backend, TorchScriptBackend):
+        raise ValueError("Only the weights of the torchscript backend can be shared")
+    module = model.backend.model
+    for tensor in itertools.chain(module.parameters(), module.buffers()):
+        tensor.share_memory_()
+
+
+def _init_worker(model_kwargs, n_threads, warmup):
+    global _MODEL
+    torch.set_num_threads(n_threads)
+    if _MODEL is None:
+        # Not shared, every worker loads its own model
+        _MODEL = HorizonNet(**model_kwargs)
+    _MODEL.warmup(warmup)
+
+
+def _predict_batch(images):
+    return _MODEL.predict_batch(images)
+
+
+def memory_usage_mb(pids):
+    """Return the total RSS and PSS in MB of the processes.
+
+    The RSS counts the shared pages once per process, the PSS splits them
+    between the processes sharing them, so its total is the memory of the host.
+    """
+    rss = pss = 0
+    for pid in pids:
+        with open("/proc/%d/smaps_rollup" % pid) as f:
+            for line in f:
+                if line.startswith("Rss:"):
+                    rss += int(line.split()[1])
+                elif line.startswith("Pss:"):
+                    pss += int(line.split()[1])
+    return rss / 1024, pss / 1024
+
+
+class SharedModelPool:
+    """Pool of forked worker processes predicting with a shared HorizonNet.
+
+    Parameters
+    ----------
+    n_workers : int
+        Number of worker processes
+    threads_per_worker : int
+        Intra-op threads of torch in each worker
+    warmup : int
+        Number of warm-up predictions of each worker, see HorizonNet.warmup
+    share : bool
+        Load the model once in the parent and share its weights with the
+        workers. If False, every worker loads its own model, for comparison
+    model_kwargs
+        Keyword arguments of HorizonNet. Frozen models inline their weights as
+        constants of the graph, which cannot be shared, so freeze is refused
+    """
+
+    def __init__(
+        self,
+        n_workers: int,
+        threads_per_worker: int = 1,
+        warmup: int = 1,
+        share: bool = True,
+        **model_kwargs,
+    ):
+        global _MODEL
+        if model_kwargs.get("freeze"):
+            raise ValueError("The weights of a frozen model cannot be shared")
+        if model_kwargs.get("warmup"):
+            raise ValueError("The parent must not run the model before forking")
+        _MODEL = None
+        if share:
+            _MODEL = HorizonNet(**model_kwargs)
+            share_weights(_MODEL)
+        self.pool = mp.get_context("fork").Pool(
+            n_workers, _init_worker, (model_kwargs, threads_per_worker, warmup)
+        )
+
+    def predict(self, image):
+        """Same as HorizonNet.predict, in a worker."""
+        return self.pool.apply(_predict_batch, ([image],))[0]
+
+    def predict_batch(self, images, batch_size=1):
+        """Same as HorizonNet.predict_batch, each batch is sent to a worker."""
+        batches = [
+            images[start : start + batch_size]
+            for start in range(0, len(images), batch_size)
+        ]
+        return [
+            prediction
+            for predictions in self.pool.map(_predict_batch, batches)
+            for prediction in predictions
+        ]
+
+    def pids(self):
+        """Return the process ids of the parent and of the workers."""
+        return [mp.current_process().pid] + [p.pid for p in mp.active_children()]
+
+    def close(self):
+        """Stop the workers."""
+        self.pool.close()
+        self.pool.join()
+
+    def __enter__(self):
+        """Return the pool, whose workers are already started."""
+        return self
+
+    def __exit__(self, *exc):
+        """Stop the workers."""
+        self.close()
@@ -0,0 +1,144 @@
+"""
+Find the fastest CPU thread settings for HorizonNet inference on this host.
+
+Every combination of intra-op threads, inter-op threads and batch size is
+benchmarked in a fresh process, because torch only lets the inter-op thread
+count be set once per process. The fastest settings are written to the
+inference config file, read at startup by HorizonNet and model/app.py.
+
+Example usage as a script, from the root of the repository:
+
+  python -m horizon_net.tune_threads --batch_size 1 4 8
+
+It will write the best settings to horizon_net/inference_config.json, or to the
+file named by the HORIZONNET_INFERENCE_CONFIG environment variable.
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import json
+import multiprocessing as mp
+import os
+import platform
+import time
+
+from .horizonnet_reconstruction import HorizonNet, IMAGE_DIRNAME, INFERENCE_CONFIG_FILE
+
+DEFAULT_IMAGE = str(IMAGE_DIRNAME / "assets" / "preprocessed" / "demo_aligned_rgb.png")
+
+
+def _default_thread_counts():
+    """Powers of two up to the number of cores, and the number of cores."""
+    n_cores = os.cpu_count() or 1
+    counts = []
+    n = 1
+    while n < n_cores:
+        counts.append(n)
+        n *= 2
+    return counts + [n_cores]
+
+
+def _run_trial(config, filename, n_images, model_kwargs):
+    """Return the images/sec of predict_batch with the given settings."""
+    model = HorizonNet(config=config, **model_kwargs)
+    images = [filename] * n_images
+    model.predict_batch(images[: config["batch_size"]])
+    start = time.perf_counter()
+    model.predict_batch(images)
+    return n_images / (time.perf_counter() - start)
+
+
+def tune(
+    filename, intra_op_threads, inter_op_threads, batch_sizes, n_images, model_kwargs
+):
+    """Benchmark every setting in a fresh process and return the fastest config."""
+    best = None
+    context = mp.get_context("spawn")
+    for intra in intra_op_threads:
+        for inter in inter_op_threads:
+            for batch_size in batch_sizes:
+                config = {
+                    "intra_op_threads": intra,
+                    "inter_op_threads": inter,
+                    "batch_size": batch_size,
+                }
+                with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                    images_per_sec = pool.submit(
+                        _run_trial, config, filename, n_images, model_kwargs
+                    ).result()
+                print("%s: %.2f images/sec" % (config, images_per_sec))
+                if best is None or images_per_sec > best["images_per_sec"]:
+                    best = dict(config, images_per_sec=images_per_sec)
+    best["host"] = {
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+    }
+    return best
+
+
+def _setup_parser():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument(
+        "--filename", type=str, default=DEFAULT_IMAGE, help="Aligned panorama image."
+    )
+    parser.add_argument(
+        "--intra_op_threads",
+        type=int,
+        nargs="+",
+        default=_default_thread_counts(),
+        help="Intra-op thread counts to try. Default is powers of two up to the number of cores.",
+    )
+    parser.add_argument(
+        "--inter_op_threads",
+        type=int,
+        nargs="+",
+        default=[1, 2],
+        help="Inter-op thread counts to try.",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        nargs="+",
+        default=[1, 4, 8],
+        help="Batch sizes of predict_batch to try.",
+    )
+    parser.add_argument(
+        "--n_images",
+        type=int,
+        default=16,
+        help="Number of images predicted in each trial.",
+    )
+    parser.add_argument(
+        "--model_kwargs",
+        type=json.loads,
+        default={},
+        help="JSON keyword arguments of HorizonNet, e.g. the variant to tune for.",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        default=INFERENCE_CONFIG_FILE,
+        help=f"Config file to write. Default is '{INFERENCE_CONFIG_FILE}'.",
+    )
+    return parser
+
+
+def main(args):
+    """Tune the thread settings and write the best one to the config file."""
+    best = tune(
+        args.filename,
+        args.intra_op_threads,
+        args.inter_op_threads,
+        args.batch_size,
+        args.n_images,
+        args.model_kwargs,
+    )
+    with open(args.output, "w") as f:
+        json.dump(best, f, indent=2)
+    print("Best settings written to %s: %s" % (args.output, best))
+
+
+if __name__ == "__main__":
+    parser = _setup_parser()
+    args = parser.parse_args()
+    main(args)
@@ -1,3 +1,4 @@
+import base64
 import json
 import os
 
@@ -5,24 +6,70 @@ import rootpath
 
 os.chdir(rootpath.append()[-1])  # noqa
 
-from horizon_net.horizonnet_reconstruction import HorizonNet  # noqa
+from horizon_net.horizonnet_reconstruction import (  # noqa
+    apply_inference_config,
+    load_inference_config,
+)
+from horizon_net.payload import encode_prediction, MIME_TYPE, to_json  # noqa
+from horizon_net.registry import DEFAULT_MODEL_NAME, ModelRegistry  # noqa
 import horizon_net.util as util  # noqa
 
-
-model = HorizonNet()
+# Apply the tuned thread settings before torch starts any parallel work
+config = load_inference_config()
+apply_inference_config(config)
+# Models are loaded on their first request, the default one is downloaded in the
+# background meanwhile unless HORIZONNET_PREFETCH is 0
+registry = ModelRegistry(config=config)
+if os.environ.get("HORIZONNET_PREFETCH", "1") != "0":
+    registry.prefetch(DEFAULT_MODEL_NAME)
 
 
 def handler(event, _context):
+    event = _from_string(event)
+    accepts_binary = _accepts_binary(event)
+    event = _from_string(event.get("body", event))
+    binary = event.get("format", "binary" if accepts_binary else "json") == "binary"
+    raw = bool(event.get("raw", False))
+    try:
+        model = registry.get(event.get("model", DEFAULT_MODEL_NAME))
+    except ValueError as e:
+        return {"prediction": str(e)}
+    except OSError as e:
+        # The artifact of the model could not be downloaded or read
+        print("ERROR loading model: %s" % e)
+        return {"prediction": "model could not be loaded: %s" % e}
+
     print("INFO loading image")
 
     image = _load_image(event)
     if image is None:
         return {"prediction": "neither image_url nor image found in event"}
     print("image loaded")
-    predictions_dict = model.predict(image)
+    predictions_dict = model.predict(image, raw=raw)
     print("INFO inference complete")
 
-    return predictions_dict
+    if binary:
+        return _binary_response(encode_prediction(predictions_dict, raw))
+    return to_json(predictions_dict)
+
+
+def _accepts_binary(event):
+    # Clients can ask for the binary payload with the Accept header of the
+    # request, or with "format": "binary" in its body
+    headers = event.get("headers") or {}
+    headers = {key.lower(): value for key, value in headers.items()}
+    return MIME_TYPE in headers.get("accept", "")
+
+
+def _binary_response(payload):
+    # The handler must return JSON to lambda, so the payload is base64 encoded
+    # here, and decoded back by the function URL which sends raw bytes
+    return {
+        "statusCode": 200,
+        "headers": {"Content-Type": MIME_TYPE},
+        "body": base64.b64encode(payload).decode("ascii"),
+        "isBase64Encoded": True,
+    }
 
 
 def _load_image(event):